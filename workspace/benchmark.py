@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+import json, os, time, shutil, socket, platform, subprocess, argparse, multiprocessing
+import numpy
+
+from ncamapgen.common import mkdir
+from ncamapgen.boundaries import load_boundaries
+from ncamapgen.points import cache_points, build_point_index
+from ncamapgen.render import load_template, render_backend
+from ncamapgen.tasks import build_tasks, run_tasks
+from ncamapgen.pipeline import map_output_files
+
+# the fields of the synthetic sources, named as in the model CSVs
+FIELDS = [
+    {'data': 'P2041_2070', 'stat': 'Stat_sig_70'},
+    {'data': 'P2070_2099', 'stat': 'Stat_sig_99'}
+]
+
+SOURCE_NODATA = -99.999
+
+# pipeline stages in the order they depend on each other, as named in the
+# task graph, and what their throughput is counted in
+STAGES = [
+    ('mapfile', 'mapfiles'),
+    ('points', 'points'),
+    ('grid', 'rasters'),
+    ('interpolate', 'rasters'),
+    ('classify', 'rasters'),
+    ('stat', 'rasters'),
+    ('project', 'rasters'),
+    ('highlight', 'renders'),
+    ('render', 'renders')
+]
+
+##
+## Functions
+##
+# Writes a global model CSV on a regular grid of the given resolution, in
+# the column layout of the model outputs, with longitudes from 0 to 360 or
+# -180 to 180. The values are a smooth field with some noise, some cells
+# are missing and the significance cycles through 1 to 3 in patches
+def generate_source(path, resolution, wrap_360, seed=0):
+    random = numpy.random.RandomState(seed)
+    start = 0.0 if wrap_360 else -180.0
+    lons = start + numpy.arange(int(360 / resolution + 1e-9)) * resolution
+    lats = -90 + resolution / 2.0 + numpy.arange(int(180 / resolution + 1e-9)) * resolution
+
+    lon, lat = numpy.meshgrid(lons, lats, indexing='ij')
+    zonal, meridian = numpy.meshgrid(numpy.arange(len(lons)) + 1, numpy.arange(len(lats)) + 1, indexing='ij')
+    columns = [zonal.ravel(), lon.ravel(), meridian.ravel(), lat.ravel()]
+    formats = ['%d', '%.4f', '%d', '%.4f']
+    for i, field in enumerate(FIELDS):
+        values = (10 * numpy.sin(numpy.radians(lat * (i + 2))) * numpy.cos(numpy.radians(lon * (i + 1)))
+                  + random.normal(0, 1, lat.shape)).ravel()
+        values[random.uniform(size=values.shape) < 0.02] = SOURCE_NODATA
+        stat = 1 + (numpy.floor(lon / 20) + numpy.floor(lat / 15) + i).astype(int).ravel() % 3
+        columns.extend([values, stat])
+        formats.extend(['%.3f', '%d'])
+
+    header = ['Zonal_Dir', 'LON', 'Merdian_Dir', 'LAT']
+    for field in FIELDS:
+        header.extend([field['data'], field['stat']])
+
+    partial = path + '.part'
+    numpy.savetxt(partial, numpy.column_stack(columns), fmt=formats, delimiter=',',
+                  header=','.join(header), comments='')
+    os.rename(partial, path)
+    return len(columns[0])
+
+def source_name(resolution, wrap_360):
+    return 'benchmark_%s_%s' % (('%g' % resolution).replace('.', 'p'), '360' if wrap_360 else '180')
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def stage_result(seconds, count, unit):
+    return {
+        'seconds': seconds,
+        'count': count,
+        'unit': unit,
+        'rate': count / seconds if seconds > 0 else None
+    }
+
+# Runs the pipeline for one source and boundary set a stage at a time, so
+# each stage is timed on its own, and returns the time and throughput of
+# each. The stages run through the same task graph and executor as
+# nca-mapgen.py, with the build manifest left out so nothing is skipped
+def run_case(source, rows, resolution, wrap_360, features_dir, args):
+    base = '%s__%s' % (os.path.splitext(os.path.basename(source))[0],
+                       os.path.basename(os.path.normpath(features_dir)))
+    config = {
+        'source': {
+            'path': source,
+            'xres': resolution,
+            'yres': resolution,
+            '0_360': wrap_360,
+            'nodata': SOURCE_NODATA,
+            'fields': FIELDS
+        },
+        'features_dir': features_dir,
+        'map_template': args.map_template,
+        'render_max': args.render_max,
+        'render_backend': args.render_backend,
+        'interpolation': args.interpolation,
+        'stat_overlay': args.stat_overlay,
+        'render_srs': args.render_srs,
+        'ingest_chunk_rows': args.ingest_chunk_rows
+    }
+    stages = {}
+
+    # start from nothing, so that the point cache is always rebuilt
+    if os.path.exists(base):
+        shutil.rmtree(base)
+
+    seconds, boundaries = timed(load_boundaries, features_dir, resolution, resolution, args.render_max,
+                                os.path.join(args.data, 'boundary_cache'), None, False, args.render_srs)
+    stages['boundaries'] = stage_result(seconds, len(boundaries), 'boundaries')
+    template = load_template(args.map_template)
+
+    output_files_map = map_output_files(base, boundaries, FIELDS, args.map_template, render_srs=args.render_srs)
+    for outdir in output_files_map['dirs'].values():
+        mkdir(outdir)
+
+    def ingest():
+        points_dir = cache_points(source, FIELDS, wrap_360, output_files_map['dirs']['cache'],
+                                  args.ingest_chunk_rows, [boundary['extent'] for boundary in boundaries])
+        build_point_index(points_dir)
+        return points_dir
+    seconds, points_dir = timed(ingest)
+    stages['ingest'] = stage_result(seconds, rows, 'points')
+
+    tasks = build_tasks(output_files_map, config, points_dir, template)
+    for stage, unit in STAGES:
+        stage_tasks = {}
+        for name, current in tasks.items():
+            if name.split('/')[-1].split(':')[0] == stage:
+                stage_tasks[name] = dict(current, deps=[], manifest=None)
+        seconds, _ = timed(run_tasks, stage_tasks, args.jobs)
+
+        count = len(stage_tasks)
+        if stage == 'points':
+            count = sum(len(numpy.load(geo_file['points_ids_file']))
+                        for geo_file in output_files_map['geo_files'].values())
+        elif stage == 'grid':
+            count = len(stage_tasks) * len(FIELDS)
+        stages[stage] = stage_result(seconds, count, unit)
+
+    if not args.keep:
+        shutil.rmtree(base)
+        os.remove(output_files_map['map_file'])
+
+    return stages
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the nca-mapgen pipeline on synthetic global model grids.')
+    parser.add_argument('-r', '--resolutions', type=float, nargs='+', default=[2.8, 2.0, 1.5, 1.0, 0.5, 0.25],
+                        help='grid resolutions in degrees to generate sources at (default: 2.8 to 0.25)')
+    parser.add_argument('-l', '--layouts', nargs='+', choices=['360', '180'], default=['360', '180'],
+                        help='longitude layouts of the sources, 0 to 360 and/or -180 to 180 (default: both)')
+    parser.add_argument('-b', '--boundaries', nargs='+', default=['input/boundaries', 'input/all_boundaries'],
+                        help='boundary dirs to run every source against')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes to run each stage on (default: 1)')
+    parser.add_argument('--map-template', default='input/mapdata/nca.map.tpl')
+    parser.add_argument('--render-max', type=int, default=1800)
+    parser.add_argument('--render-backend', default='auto', help='auto, mapscript, cgi or numpy (default: auto)')
+    parser.add_argument('--interpolation', default='bilinear')
+    parser.add_argument('--stat-overlay', default='polygons')
+    parser.add_argument('--render-srs', default='EPSG:4326', help='srs to render in, such as EPSG:5070 (default: EPSG:4326)')
+    parser.add_argument('--ingest-chunk-rows', type=int, help='stream the sources this many rows at a time')
+    parser.add_argument('--data', default='benchmark_data',
+                        help='dir the synthetic sources are generated in and kept, for reuse (default: benchmark_data)')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='file each case\'s results are appended to as a line of JSON (default: benchmark_results.jsonl)')
+    parser.add_argument('--keep', action='store_true', help='keep the output dirs of every case')
+    args = parser.parse_args()
+
+    mkdir(args.data)
+    run = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': git_commit(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpus': multiprocessing.cpu_count(),
+        'jobs': args.jobs,
+        'render_max': args.render_max,
+        'render_backend': render_backend({'render_backend': args.render_backend}),
+        'interpolation': args.interpolation,
+        'stat_overlay': args.stat_overlay,
+        'render_srs': args.render_srs,
+        'ingest_chunk_rows': args.ingest_chunk_rows
+    }
+
+    for resolution in args.resolutions:
+        for layout in args.layouts:
+            wrap_360 = layout == '360'
+            source = os.path.join(args.data, '%s.csv' % source_name(resolution, wrap_360))
+            if os.path.exists(source):
+                rows = sum(1 for line in open(source)) - 1
+            else:
+                rows = generate_source(source, resolution, wrap_360)
+
+            for features_dir in args.boundaries:
+                stages = run_case(source, rows, resolution, wrap_360, features_dir, args)
+                result = dict(run, resolution=resolution, layout=layout, rows=rows,
+                              features_dir=features_dir, stages=stages)
+                with open(args.results, 'a') as file_out:
+                    file_out.write(json.dumps(result, sort_keys=True) + '\n')
+
+                print('%g deg, %s, %d points, %s' % (resolution, layout, rows, features_dir))
+                for stage in ['boundaries', 'ingest'] + [name for name, unit in STAGES]:
+                    current = stages[stage]
+                    print('  %-12s %8.3f s %10d %-10s %12.1f /s' % (
+                        stage, current['seconds'], current['count'], current['unit'], current['rate'] or 0))
+
+if __name__ == '__main__':
+    main()
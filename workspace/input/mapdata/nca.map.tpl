@@ -13,6 +13,7 @@ MAP
   WEB
     METADATA
       ows_enable_request "*"
+      ows_srs "EPSG:4326 EPSG:3857 EPSG:5070"
     END
   END
 
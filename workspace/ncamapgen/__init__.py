@@ -0,0 +1,8 @@
+##
+## nca-mapgen
+## Generates map images from NCA model data. Pipeline runs the whole
+## pipeline, or renders a single boundary/field, as many times as needed
+## in one process; nca-mapgen.py is its command line
+##
+from .pipeline import Pipeline, run
+from .cli import main
@@ -0,0 +1,226 @@
+##
+## Boundaries
+## The boundary shapefiles, their extents and the simplified copies of
+## them that are rendered, along with any highlight shapefiles of each.
+## When rendering in another srs than 4326, these are also projected into
+## it once here, rather than by MapServer for every image
+##
+import json, os, glob, hashlib
+from osgeo import ogr
+
+from .common import mkdir, shapefile_hash, image_scale, ogr_driver, spatial_ref, coordinate_transform, srs_suffix
+
+def get_extent(layer, xres, yres):
+    driver = ogr_driver('ESRI Shapefile')
+    data_source = driver.Open(layer, 0)
+    layer = data_source.GetLayer()
+    extent = list(layer.GetExtent())
+    # correct coordinate bbox coordinate order to conform with the rest of everything
+    extent[2], extent[1] = extent[1], extent[2]
+    return extent
+
+# widens the extent by one resolution unit to make sure we
+# get data that will fully encapsulate the area
+def widen_extent(extent, xres, yres):
+    new_extent = []
+    # left-most x-coordinate
+    new_extent.append(extent[0] - xres)
+    # bottom-most y-coordinate
+    new_extent.append(extent[1] - yres)
+    # right-most x-coordinate
+    new_extent.append(extent[2] + xres)
+    # top-most y-coordinate
+    new_extent.append(extent[3] + yres)
+
+    return new_extent
+
+# slightly widen the extent to make sure lines aren't clipped. The bottom
+# can be widened by its own factor, to leave room below the boundary
+def widen_extent_by_factor(extent, factor, bottom_factor=None):
+    if bottom_factor is None:
+        bottom_factor = factor
+    new_extent = []
+    # left-most x-coordinate
+    new_extent.append(extent[0] * (1 + factor))
+    # bottom-most y-coordinate
+    new_extent.append(extent[1] * (1 - bottom_factor))
+    # right-most x-coordinate
+    new_extent.append(extent[2] * (1 - factor))
+    # top-most y-coordinate
+    new_extent.append(extent[3] * (1 + factor))
+
+    return new_extent
+
+# Works out the extents of each boundary, through the boundary cache, so
+# the boundaries can be shared by every source processed in a run. With
+# highlights, the shapefiles in the dir named after a boundary, such as
+# <features_dir>/<boundary>/*.shp, are each outlined on its renders
+def load_boundaries(features_dir, xres, yres, render_max, cache_dir, bottom_factor=None, highlights=False,
+                    render_srs='EPSG:4326'):
+    boundaries = []
+
+    # build list of boundary files
+    boundary_files = glob.glob('%s*.shp' % features_dir)
+
+    mkdir(cache_dir)
+    for boundary_file in boundary_files:
+        boundary_name = os.path.splitext(os.path.basename(boundary_file))[0]
+        cached = cache_boundary(boundary_file, xres, yres, render_max, cache_dir, bottom_factor, render_srs)
+        boundaries.append({
+            'boundary_file': boundary_file,
+            'boundary_file_name': boundary_name,
+            'boundary_hash': cached['hash'],
+            'render_boundary_file': cached['simplified_file'],
+            'projected_boundary_file': cached['projected_file'],
+            'render_extent': widen_extent_by_factor(cached['extent'], 0.0003, bottom_factor),
+            'extent': widen_extent(cached['extent'], xres, yres),
+            'highlight_files': load_highlights(features_dir, boundary_name, cache_dir, render_srs) if highlights else []
+        })
+
+    return boundaries
+
+def load_highlights(features_dir, boundary_name, cache_dir, render_srs='EPSG:4326'):
+    highlights = []
+    for highlight_file in sorted(glob.glob('%s%s/*.shp' % (features_dir, boundary_name))):
+        highlight_name = os.path.splitext(os.path.basename(highlight_file))[0]
+        highlight_key = '%s_%s' % (highlight_name, boundary_name)
+        highlight_hash = shapefile_hash(highlight_file)
+        projected_file = None
+        if render_srs.upper() != 'EPSG:4326':
+            projected_file = os.path.join(cache_dir, '%s_%s_%s.shp' % (highlight_key, highlight_hash[:12],
+                                                                       srs_suffix(render_srs)))
+            if not cached_copy(projected_file):
+                project_shapefile(highlight_file, projected_file, render_srs)
+        highlights.append({
+            'name': highlight_name,
+            'key': highlight_key,
+            'path': highlight_file,
+            'projected_path': projected_file,
+            'hash': highlight_hash
+        })
+    return highlights
+
+# mtime and size of each of the shapefile's parts
+def shapefile_stamp(path):
+    base = os.path.splitext(path)[0]
+    stamp = []
+    for ext in ['shp', 'shx', 'dbf', 'prj']:
+        part = '%s.%s' % (base, ext)
+        if os.path.exists(part):
+            stat = os.stat(part)
+            stamp.append([ext, stat.st_mtime, stat.st_size])
+    return stamp
+
+## Boundary cache
+## A JSON sidecar per boundary shapefile, keyed by its path so boundaries
+## of the same name in different features dirs don't collide, holds its
+## hash and extent. The shapefile is only re-read when its mtime or size
+## changes. The copies of its geometry simplified to the render pixel size,
+## with a .qix spatial index for MapServer, and of those projected into a
+## render srs other than 4326 are named by the hash and the tolerance, so
+## that runs with different render sizes or extents share the cache
+## without re-simplifying, or overwriting, each other's copies
+def cache_boundary(boundary_file, xres, yres, render_max, cache_dir, bottom_factor=None, render_srs='EPSG:4326'):
+    boundary_name = os.path.splitext(os.path.basename(boundary_file))[0]
+    path_key = hashlib.sha1(os.path.abspath(boundary_file).encode('utf-8')).hexdigest()[:8]
+    sidecar = os.path.join(cache_dir, '%s_%s.json' % (boundary_name, path_key))
+
+    cached = {}
+    if os.path.exists(sidecar):
+        with open(sidecar) as file_in:
+            cached = json.load(file_in)
+
+    stamp = shapefile_stamp(boundary_file)
+    if cached.get('stamp') != stamp:
+        boundary_hash = shapefile_hash(boundary_file)
+        if cached.get('hash') != boundary_hash:
+            cached = {
+                'hash': boundary_hash,
+                'extent': get_extent(boundary_file, xres, yres)
+            }
+        cached['stamp'] = stamp
+        with open(sidecar, 'wt') as file_out:
+            json.dump(cached, file_out, indent=2)
+
+    # one pixel of the boundary's render
+    render_extent = widen_extent_by_factor(cached['extent'], 0.0003, bottom_factor)
+    image_dimensions = image_scale(render_extent, render_max)
+    tolerance = (render_extent[2] - render_extent[0]) / image_dimensions['width']
+    simplified_key = hashlib.sha1(('%s:%r' % (cached['hash'], tolerance)).encode('utf-8')).hexdigest()[:12]
+
+    simplified_file = os.path.join(cache_dir, '%s_%s.shp' % (boundary_name, simplified_key))
+    if not cached_copy(simplified_file):
+        simplify_boundary(boundary_file, simplified_file, tolerance)
+
+    projected_file = None
+    srs = render_srs.upper()
+    if srs != 'EPSG:4326':
+        projected_file = os.path.join(cache_dir, '%s_%s_%s.shp' % (boundary_name, simplified_key, srs_suffix(srs)))
+        if not cached_copy(projected_file):
+            project_shapefile(simplified_file, projected_file, srs)
+
+    return dict(cached, simplified_file=simplified_file, projected_file=projected_file)
+
+# the spatial index is written last, so a copy left part way through by an
+# interrupted run is made again
+def cached_copy(path):
+    return os.path.exists('%s.qix' % os.path.splitext(path)[0])
+
+def simplify_boundary(boundary_file, simplified_file, tolerance):
+    driver = ogr_driver('ESRI Shapefile')
+    source = driver.Open(boundary_file, 0)
+    layer = source.GetLayer()
+
+    if os.path.exists(simplified_file):
+        driver.DeleteDataSource(simplified_file)
+    target = driver.CreateDataSource(simplified_file)
+    layer_name = os.path.splitext(os.path.basename(simplified_file))[0]
+    simplified_layer = target.CreateLayer(layer_name, srs = layer.GetSpatialRef(), geom_type = layer.GetGeomType())
+
+    layer_defn = simplified_layer.GetLayerDefn()
+    for feature in layer:
+        simplified = ogr.Feature(layer_defn)
+        geometry = feature.GetGeometryRef()
+        if geometry is not None:
+            simplified.SetGeometry(geometry.SimplifyPreserveTopology(tolerance))
+        simplified_layer.CreateFeature(simplified)
+
+    # writes the .qix that MapServer uses for shapefiles
+    target.ExecuteSQL('CREATE SPATIAL INDEX ON %s' % layer_name)
+
+    # dereference to flush to disk
+    target = None
+
+# Copies a 4326 shapefile, such as a simplified boundary or the polygonized
+# stats, with its fields, into srs
+def project_shapefile(source_file, projected_file, srs):
+    driver = ogr_driver('ESRI Shapefile')
+    source = driver.Open(source_file, 0)
+    layer = source.GetLayer()
+    xform = coordinate_transform('EPSG:4326', srs)
+
+    if os.path.exists(projected_file):
+        driver.DeleteDataSource(projected_file)
+    target = driver.CreateDataSource(projected_file)
+    layer_name = os.path.splitext(os.path.basename(projected_file))[0]
+    projected_layer = target.CreateLayer(layer_name, srs = spatial_ref(srs), geom_type = layer.GetGeomType())
+
+    source_defn = layer.GetLayerDefn()
+    for i in range(source_defn.GetFieldCount()):
+        projected_layer.CreateField(source_defn.GetFieldDefn(i))
+
+    layer_defn = projected_layer.GetLayerDefn()
+    for feature in layer:
+        projected = ogr.Feature(layer_defn)
+        projected.SetFrom(feature)
+        geometry = feature.GetGeometryRef()
+        if geometry is not None:
+            geometry = geometry.Clone()
+            geometry.Transform(xform)
+            projected.SetGeometry(geometry)
+        projected_layer.CreateFeature(projected)
+
+    target.ExecuteSQL('CREATE SPATIAL INDEX ON %s' % layer_name)
+
+    # dereference to flush to disk
+    target = None
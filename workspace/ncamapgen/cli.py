@@ -0,0 +1,63 @@
+##
+## Command line
+##
+import json, argparse, time
+
+from .profiling import start_profile, take_profile_records, profile_stage, write_profile
+from .pipeline import Pipeline, expand_sources
+from .service import serve
+
+# defaults are config settings that config.json can override, such as the
+# highlight script's
+def main(defaults=None):
+    parser = argparse.ArgumentParser(description='Generate map images from NCA model data.')
+    parser.add_argument('sources', nargs='*',
+                        help='source CSVs or glob patterns to process in one run, each with the '
+                             'source settings of config.json (default: the source path in config.json)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes to run the pipeline on (default: 1)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rebuild every output, even if its inputs are unchanged')
+    parser.add_argument('--profile', nargs='?', const='profile.json', metavar='REPORT',
+                        help='record the time, CPU, memory and I/O of every stage and write them '
+                             'to REPORT (default: profile.json), printing a summary')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='run as a service taking jobs over HTTP on ADDRESS, [host:]port or the path '
+                             'of a Unix socket, instead of processing the sources')
+    args = parser.parse_args()
+    if args.profile:
+        start_profile()
+    run_start = time.time()
+
+    # Get properties
+    ## TODO parameterize this from a command-line arg
+    config = dict(defaults or {})
+    config_file = open('config.json')
+    config.update(json.load(config_file))
+    config_file.close()
+
+    if args.serve:
+        serve(config, args.serve, args.jobs)
+        return
+
+    sources = [config['source']['path']]
+    if args.sources:
+        try:
+            sources = expand_sources(args.sources)
+        except ValueError as error:
+            parser.error(str(error))
+
+    # the map template is shared by every source, and the boundaries by
+    # every source of the same resolution
+    with profile_stage('template'):
+        pipeline = Pipeline(config, args.jobs)
+
+    # extract, grid, interpolate, overlay and render every boundary of
+    # every source, skipping anything already built from the same inputs
+    try:
+        pipeline.run(sources, args.force)
+    finally:
+        pipeline.close()
+
+    if args.profile:
+        write_profile(take_profile_records(), args.profile, time.time() - run_start, args.jobs)
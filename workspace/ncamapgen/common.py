@@ -0,0 +1,131 @@
+##
+## Shared helpers
+## Constants, file hashing and the GDAL objects that are reused across
+## calls. Drivers and spatial references are looked up once per process
+## and kept, so a long-lived Pipeline or worker doesn't rebuild them for
+## every raster and render
+##
+import os, hashlib
+import numpy
+from osgeo import ogr, osr, gdal
+
+# nodata value of the generated data rasters
+NODATA = -9999.0
+
+# creation options for rasters that are read back at several resolutions
+TILED_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256']
+
+def mkdir(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+def filename(base, dr, ext):
+    return os.path.join(base, dr, '%s.%s' % (base, ext))
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file_in:
+        for block in iter(lambda: file_in.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# hashes several files together, skipping any that don't exist
+def files_hash(paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.exists(path):
+            digest.update(('%s:%s;' % (os.path.basename(path), file_hash(path))).encode('utf-8'))
+    return digest.hexdigest()
+
+def shapefile_hash(path):
+    base = os.path.splitext(path)[0]
+    return files_hash(['%s.%s' % (base, ext) for ext in ['shp', 'shx', 'dbf', 'prj']])
+
+# write then rename so a partial file is never picked up by another run
+def save_array(path, array):
+    part_file = '%s.part' % path
+    with open(part_file, 'wb') as file_out:
+        numpy.save(file_out, array)
+    os.rename(part_file, path)
+
+def image_scale(extent, render_max):
+    extent_width = extent[2] - extent[0]
+    extent_height = extent[3] - extent[1]
+    
+    image_width = image_height = render_max
+    if extent_width > extent_height:
+        image_height = extent_height / extent_width * render_max
+    else:
+        image_width = extent_width / extent_height * render_max
+
+    image_width_height = {
+        'width': image_width, 
+        'height': image_height
+    }
+
+    return image_width_height
+
+# drivers and spatial references already looked up by this process
+gdal_drivers = {}
+ogr_drivers = {}
+spatial_refs = {}
+coordinate_transforms = {}
+
+def gdal_driver(name):
+    if name not in gdal_drivers:
+        gdal_drivers[name] = gdal.GetDriverByName(name)
+    return gdal_drivers[name]
+
+def ogr_driver(name):
+    if name not in ogr_drivers:
+        ogr_drivers[name] = ogr.GetDriverByName(name)
+    return ogr_drivers[name]
+
+# shared between callers, so they must not be modified
+def spatial_ref(srs):
+    key = srs.upper()
+    if key not in spatial_refs:
+        ref = osr.SpatialReference()
+        ref.SetFromUserInput(srs)
+        # GDAL 3 would otherwise take 4326 coordinates as lat/lon
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        spatial_refs[key] = ref
+    return spatial_refs[key]
+
+def coordinate_transform(source_srs, target_srs):
+    key = (source_srs.upper(), target_srs.upper())
+    if key not in coordinate_transforms:
+        coordinate_transforms[key] = osr.CoordinateTransformation(spatial_ref(source_srs), spatial_ref(target_srs))
+    return coordinate_transforms[key]
+
+# Transforms a 4326 extent along its edges, densified to steps points a
+# side in one call, since a projected extent can bulge beyond its corners.
+# Latitudes are clamped to where web mercator is defined. A 4326 extent is
+# returned as is
+def transform_extent(extent, srs, steps=20):
+    if srs.upper() == 'EPSG:4326':
+        return list(extent)
+    min_y, max_y = extent[1], extent[3]
+    if srs.upper() == 'EPSG:3857':
+        min_y, max_y = max(min_y, -85.0511), min(max_y, 85.0511)
+    xs = numpy.linspace(extent[0], extent[2], steps + 1)
+    ys = numpy.linspace(min_y, max_y, steps + 1)
+    edge_x = numpy.concatenate([xs, xs, numpy.full(ys.shape, extent[0]), numpy.full(ys.shape, extent[2])])
+    edge_y = numpy.concatenate([numpy.full(xs.shape, min_y), numpy.full(xs.shape, max_y), ys, ys])
+
+    points = numpy.array(coordinate_transform('EPSG:4326', srs).TransformPoints(
+        numpy.column_stack([edge_x, edge_y]).tolist()))
+    return [points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()]
+
+# The extent and whole pixel size of the boundary's render in srs, which
+# both the render and the rasters projected for it use, so that they line
+# up pixel for pixel
+def render_grid_size(render_extent, srs, render_max):
+    extent = transform_extent(render_extent, srs)
+    image_dimensions = image_scale(extent, render_max)
+    return extent, int(image_dimensions['width']), int(image_dimensions['height'])
+
+# the name an srs such as EPSG:5070 gives to files projected into it
+def srs_suffix(srs):
+    return srs.split(':')[-1].lower()
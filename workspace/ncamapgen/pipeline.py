@@ -0,0 +1,253 @@
+##
+## Pipeline
+## Lays out the outputs and task graph of each source. A Pipeline keeps
+## the map template, the boundaries of each resolution and its worker
+## pool between runs, so that it can be run again and again in the same
+## process without starting over
+##
+import os, glob, multiprocessing
+
+from .common import mkdir, srs_suffix
+from .profiling import profile_stage
+from .boundaries import load_boundaries
+from .points import cache_points, source_resolution, build_point_index
+from .render import load_template, render_backend, render_outputs
+from .tasks import build_tasks, run_tasks, WorkerLostError
+
+# This funciton goes ahead and figures out all the 
+# file output details in one place. Some advantages
+#  1: one place handles all the string concatenation
+#     etc, so methods are much more focused on the
+#     business logic and have simpler method signitures
+#  2: elements can be calculated in groups more simply
+#     so that related things (like a boundary file and
+#     the various rasters it is associated with) can
+#     be grouped much more simply, even if they are
+#     generated in several places
+# Intermediate rasters named in memory_rasters (such as
+# 'stat_grid' or 'interpolation_file') are mapped into
+# GDAL's /vsimem/ filesystem instead of temp. Renders in
+# another srs than 4326 also get the paths of the rasters
+# projected into it
+def map_output_files(base, boundaries, fields, map_template, memory_rasters=(), render_srs='EPSG:4326'):
+    output_map = {
+        'dirs': {
+            'base': base,
+            'temp': os.path.join(base, 'temp'),
+            'data': os.path.join(base, 'data'),
+            'renders': os.path.join(base, 'renders'),
+            'cache': os.path.join(base, 'cache')
+        },
+        'map_file': os.path.join(os.path.dirname(map_template), '%s.map' % base),
+        'manifest': os.path.join(base, 'manifest.json'),
+        'geo_files': {}
+    }
+
+    for boundary in boundaries:
+        boundary_name = boundary['boundary_file_name']
+        base_boundary_portion = '%s__%s' % (base, boundary_name)
+
+        output_map['geo_files'][boundary_name] = dict(boundary)
+        output_map['geo_files'][boundary_name].update({
+            'points_ids_file': os.path.join(output_map['dirs']['temp'], '%s_ids.npy' % base_boundary_portion),
+            # each highlight's outline alone, composited over every field
+            'highlight_overlay_files': dict(
+                (highlight['name'], os.path.join(output_map['dirs']['temp'],
+                                                 '%s__%s_highlight.png' % (base_boundary_portion, highlight['name'])))
+                for highlight in boundary['highlight_files']),
+            'rasters': []
+        })
+
+        for field in fields:
+            raster_layer_name = '%s__%s' % (base_boundary_portion, field['data'])
+            stat_layer_name = '%s__%s' % (base_boundary_portion, field['stat'])
+            output_map['geo_files'][boundary_name]['rasters'].append({
+                'field': field['data'],
+                'grid_layer_name': raster_layer_name,
+                'grid_file': os.path.join(output_map['dirs']['data'], '%s.tif' % raster_layer_name),
+                'render_file': os.path.join(output_map['dirs']['renders'], '%s.png' % raster_layer_name),
+                'interpolation_file': os.path.join(output_map['dirs']['temp'], '%s_interpolation.tif' % raster_layer_name),
+                'classified_file': os.path.join(output_map['dirs']['temp'], '%s_classes.tif' % raster_layer_name),
+                'stat_field': field['stat'],
+                'stat_layer_name': stat_layer_name,
+                'stat_grid': os.path.join(output_map['dirs']['temp'], '%s.tif' % stat_layer_name),
+                'stat_shp': os.path.join(output_map['dirs']['data'], '%s.shp' % stat_layer_name),
+                'stat_hatch': os.path.join(output_map['dirs']['temp'], '%s_hatch.tif' % stat_layer_name),
+                'tiles_dir': os.path.join(base, 'tiles', raster_layer_name),
+                'highlight_render_files': dict(
+                    (highlight['name'], os.path.join(output_map['dirs']['renders'],
+                                                     '%s__%s.png' % (raster_layer_name, highlight['name'])))
+                    for highlight in boundary['highlight_files'])
+            })
+
+            raster = output_map['geo_files'][boundary_name]['rasters'][-1]
+            if render_srs.upper() != 'EPSG:4326':
+                suffix = srs_suffix(render_srs)
+                raster.update({
+                    'projected_file': os.path.join(output_map['dirs']['temp'],
+                                                   '%s_classes_%s.tif' % (raster_layer_name, suffix)),
+                    'projected_hatch': os.path.join(output_map['dirs']['temp'],
+                                                    '%s_hatch_%s.tif' % (stat_layer_name, suffix)),
+                    'projected_stat_shp': os.path.join(output_map['dirs']['temp'],
+                                                       '%s_%s.shp' % (stat_layer_name, suffix))
+                })
+            for key in memory_rasters:
+                raster[key] = '/vsimem/%s/%s' % (base, os.path.basename(raster[key]))
+
+    return output_map
+
+# expands any glob patterns in the source list, keeping their order; a
+# pattern that matches nothing is more likely a typo than intended
+def expand_sources(patterns):
+    sources = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise ValueError('No source files match %s' % pattern)
+        for match in matches:
+            if match not in sources:
+                sources.append(match)
+    return sources
+
+# The output files map limited to the given fields and boundaries, if any
+def select_outputs(output_files_map, field_names=None, boundary_names=None):
+    geo_files = {}
+    for boundary_name, geo_file in output_files_map['geo_files'].items():
+        if boundary_names and boundary_name not in boundary_names:
+            continue
+        geo_files[boundary_name] = dict(geo_file, rasters=[raster for raster in geo_file['rasters']
+                                                           if not field_names or raster['field'] in field_names])
+    return dict(output_files_map, geo_files=geo_files)
+
+# Lays out the task graph of every source, loading the boundaries of each
+# resolution only once into boundary_sets. The fields and boundaries can
+# be limited to the given names; the mapfile still holds the layers of
+# every one, so that runs of different subsets share it rather than each
+# rewriting it. Returns the tasks and the (limited) output files map of
+# each source
+def plan_sources(config, sources, template, boundary_sets, force=False, field_names=None, boundary_names=None):
+    base_names = [os.path.splitext(os.path.basename(source))[0] for source in sources]
+    if len(set(base_names)) != len(base_names):
+        raise ValueError('Sources must have distinct file names, as they name the output dirs')
+
+    fields = config['source']['fields']
+    if field_names:
+        unknown = set(field_names) - set(field['data'] for field in fields)
+        if unknown:
+            raise ValueError('Unknown fields: %s' % ', '.join(sorted(unknown)))
+
+    render_srs = config.get('render_srs', 'EPSG:4326')
+
+    # intermediate rasters can be kept in memory, but the mapserv binary
+    # can only read the rasters it draws from disk
+    memory_rasters = []
+    if config.get('in_memory', False):
+        memory_rasters.extend(['stat_grid', 'interpolation_file'])
+        if render_backend(config) in ('mapscript', 'numpy'):
+            memory_rasters.extend(['classified_file', 'stat_hatch'])
+            if render_srs.upper() != 'EPSG:4326':
+                memory_rasters.extend(['projected_file', 'projected_hatch'])
+
+    tasks = {}
+    output_maps = []
+    for source, base_name in zip(sources, base_names):
+        xres, yres = source_resolution(source, config['source'])
+        source_config = dict(config)
+        source_config['source'] = dict(config['source'], path=source, xres=xres, yres=yres, fields=fields)
+
+        if (xres, yres) not in boundary_sets:
+            with profile_stage('boundaries'):
+                boundary_sets[(xres, yres)] = load_boundaries(config['features_dir'],
+                                                              xres,
+                                                              yres,
+                                                              config['render_max'],
+                                                              config.get('boundary_cache', 'boundary_cache'),
+                                                              config.get('render_bottom_factor'),
+                                                              config.get('highlights', False),
+                                                              render_srs)
+        boundaries = boundary_sets[(xres, yres)]
+        # streamed sources only keep the points any boundary needs, all of
+        # them so that the point cache is shared by any selection
+        extents = [boundary['extent'] for boundary in boundaries]
+        if boundary_names:
+            unknown = set(boundary_names) - set(boundary['boundary_file_name'] for boundary in boundaries)
+            if unknown:
+                raise ValueError('Unknown boundaries: %s' % ', '.join(sorted(unknown)))
+
+        # create full intended output listing
+        full_map = map_output_files(base_name, boundaries, fields, config['map_template'], memory_rasters,
+                                    render_srs)
+        output_files_map = select_outputs(full_map, field_names, boundary_names)
+
+        # make output structure
+        for outdir in output_files_map['dirs'].values():
+            mkdir(outdir)
+
+        # load points once, correcting the meridian if needed
+        with profile_stage('%s/source' % base_name):
+            points_dir = cache_points(source, fields, config['source']['0_360'], output_files_map['dirs']['cache'],
+                                      config.get('ingest_chunk_rows'), extents)
+            build_point_index(points_dir)
+
+        if force and os.path.exists(output_files_map['manifest']):
+            os.remove(output_files_map['manifest'])
+        tasks.update(build_tasks(output_files_map, source_config, points_dir, template,
+                                 list(full_map['geo_files'].values())))
+        output_maps.append(output_files_map)
+
+    return tasks, output_maps
+
+class Pipeline(object):
+    # With more than one job, the worker pool is forked here, after the
+    # template is loaded, and kept until close
+    def __init__(self, config, jobs=1):
+        self.config = config
+        self.jobs = jobs
+        self.template = load_template(config['map_template'])
+        # the boundaries of each source resolution, loaded on first use
+        self.boundary_sets = {}
+        self.pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def plan(self, sources=None, force=False, fields=None, boundaries=None):
+        return plan_sources(self.config, sources or [self.config['source']['path']], self.template,
+                            self.boundary_sets, force, fields, boundaries)
+
+    # Builds whatever is out of date for the sources (by default the
+    # configured one), limited to the given fields and boundaries if any,
+    # and returns the output files map of each source
+    def run(self, sources=None, force=False, fields=None, boundaries=None):
+        tasks, output_maps = self.plan(sources, force, fields, boundaries)
+        try:
+            run_tasks(tasks, self.jobs, self.pool)
+        except WorkerLostError:
+            # the lost task's siblings may still be running, so the next
+            # run starts on a fresh pool
+            if self.pool is not None:
+                self.close()
+                self.pool = multiprocessing.Pool(self.jobs)
+            raise
+        return output_maps
+
+    # builds just what one boundary/field's renders need, and returns
+    # their paths
+    def render(self, field, boundary, source=None):
+        output_maps = self.run([source] if source else None, fields=[field], boundaries=[boundary])
+        geo_file = output_maps[0]['geo_files'][boundary]
+        return [output for raster in geo_file['rasters'] for output in render_outputs(geo_file, raster)]
+
+# runs the pipeline once over the sources, as the command line does
+def run(config, sources=None, jobs=1, force=False):
+    with Pipeline(config, jobs) as pipeline:
+        return pipeline.run(sources, force)
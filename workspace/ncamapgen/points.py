@@ -0,0 +1,237 @@
+##
+## Points
+## The source CSV's points, cached as a .npy file per column with a
+## longitude index, and the selections of them within each boundary
+##
+import json, os, hashlib, itertools
+import numpy
+
+from .common import mkdir, file_hash, save_array
+
+def point_columns(fields):
+    columns = ['LON', 'LAT']
+    for field in fields:
+        columns.append(field['data'])
+        columns.append(field['stat'])
+    return columns
+
+## Parses the LON/LAT and every data/stat column of the CSV into typed
+## arrays. If wrap_360 is set, longitudes of 180 or more are corrected
+## to be within -180 to 180
+def parse_points(csv_path, fields, wrap_360):
+    with open(csv_path) as file_in:
+        header = file_in.readline().strip().split(',')
+
+    columns = point_columns(fields)
+    values = numpy.loadtxt(csv_path,
+                           delimiter=',',
+                           skiprows=1,
+                           usecols=[header.index(column) for column in columns],
+                           ndmin=2)
+
+    points = {}
+    for i, column in enumerate(columns):
+        points[column] = values[:, i]
+
+    if wrap_360:
+        lon = points['LON']
+        lon[lon >= 180] -= 360
+
+    # significance only holds small class values
+    for field in fields:
+        stat = points[field['stat']]
+        if numpy.array_equal(stat, numpy.round(stat)):
+            points[field['stat']] = stat.astype(numpy.int16)
+
+    return points
+
+# Makes sure the points are in a binary cache of one .npy file per
+# column, keyed by the content hash of the CSV. The CSV is only parsed if
+# the cache is missing any column. Returns the cache directory
+# With chunk_rows, the CSV is streamed instead of parsed whole, and only
+# the points within any of the extents are kept, so the cache is also
+# keyed by the extents
+def cache_points(csv_path, fields, wrap_360, cache_dir, chunk_rows=None, extents=None):
+    key = file_hash(csv_path)
+    if wrap_360:
+        key += '_180'
+    if chunk_rows:
+        key += '_%s' % hashlib.sha1(json.dumps(extents).encode('utf-8')).hexdigest()[:12]
+    points_dir = os.path.join(cache_dir, key)
+
+    columns = point_columns(fields)
+    column_files = {}
+    for column in columns:
+        column_files[column] = os.path.join(points_dir, '%s.npy' % column)
+
+    if not all(os.path.exists(path) for path in column_files.values()):
+        mkdir(points_dir)
+        if chunk_rows:
+            stream_points(csv_path, fields, wrap_360, extents, chunk_rows, points_dir)
+        else:
+            parsed = parse_points(csv_path, fields, wrap_360)
+            for column in columns:
+                save_array(column_files[column], parsed[column])
+
+    return points_dir
+
+# Model grids carry the column and row of every cell in Zonal_Dir and
+# Merdian_Dir. Infers the resolution from how LON and LAT step with
+# them over the first sample_rows rows. Returns None if the CSV has no
+# index columns or they don't describe a regular grid
+def detect_grid(csv_path, sample_rows=100000):
+    columns = ['Zonal_Dir', 'LON', 'Merdian_Dir', 'LAT']
+    with open(csv_path) as file_in:
+        header = file_in.readline().strip().split(',')
+        if not all(column in header for column in columns):
+            return None
+        lines = list(itertools.islice(file_in, sample_rows))
+    if not lines:
+        return None
+
+    values = numpy.loadtxt(lines, delimiter=',', usecols=[header.index(column) for column in columns], ndmin=2)
+    xres = grid_step(values[:, 0], values[:, 1], 360)
+    yres = grid_step(values[:, 2], values[:, 3])
+    if xres is None or yres is None:
+        return None
+    return {'xres': xres, 'yres': yres}
+
+# The step is the median change of the coordinate between consecutive
+# indices. The grid counts as regular if nearly every point (allowing for
+# the odd stray row in the model outputs, and the slightly uneven
+# latitudes of Gaussian grids) is within a quarter cell of where its
+# index puts it. period wraps longitudes across the meridian
+def grid_step(index, coordinate, period=None):
+    unique_index, first = numpy.unique(index, return_index=True)
+    if len(unique_index) < 2:
+        return None
+
+    def wrap(delta):
+        if period is None:
+            return delta
+        return (delta + period / 2.0) % period - period / 2.0
+
+    steps = wrap(numpy.diff(coordinate[first])) / numpy.diff(unique_index)
+    step = numpy.median(steps)
+    if step == 0:
+        return None
+
+    offsets = wrap(coordinate - index * step)
+    residuals = wrap(offsets - numpy.median(offsets))
+    if numpy.mean(numpy.abs(residuals) < abs(step) / 4.0) < 0.95:
+        return None
+    return round(abs(float(step)), 6)
+
+# The resolution in the source config, if given, or else the one detected
+# from the CSV's grid indices
+def source_resolution(csv_path, source):
+    if source.get('xres') and source.get('yres'):
+        return source['xres'], source['yres']
+    grid = detect_grid(csv_path)
+    if grid is None:
+        raise ValueError('%s is not a regular grid with Zonal_Dir/Merdian_Dir indices, '
+                         'so xres and yres must be set in config.json' % csv_path)
+    return source.get('xres') or grid['xres'], source.get('yres') or grid['yres']
+
+def within_extents(lon, lat, extents):
+    keep = numpy.zeros(lon.shape, dtype=bool)
+    for extent in extents:
+        keep |= (lon >= extent[0]) & (lon <= extent[2]) & (lat >= extent[1]) & (lat <= extent[3])
+    return keep
+
+## Parses the CSV chunk_rows lines at a time, keeping only the points
+## within the extents, so that memory use is bounded by the chunk size
+## rather than the size of the CSV. The kept points are appended to a raw
+## file per column, which is then copied into the .npy cache a chunk at a
+## time, with the stat columns narrowed as in parse_points
+def stream_points(csv_path, fields, wrap_360, extents, chunk_rows, points_dir):
+    columns = point_columns(fields)
+    raw_files = [os.path.join(points_dir, '%s.raw' % column) for column in columns]
+
+    count = 0
+    with open(csv_path) as file_in:
+        header = file_in.readline().strip().split(',')
+        usecols = [header.index(column) for column in columns]
+        raw_outs = [open(path, 'wb') for path in raw_files]
+        try:
+            while True:
+                lines = list(itertools.islice(file_in, chunk_rows))
+                if not lines:
+                    break
+                values = numpy.loadtxt(lines, delimiter=',', usecols=usecols, ndmin=2)
+                lon = values[:, 0]
+                if wrap_360:
+                    lon[lon >= 180] -= 360
+                values = values[within_extents(lon, values[:, 1], extents)]
+                for i, raw_out in enumerate(raw_outs):
+                    values[:, i].tofile(raw_out)
+                count += len(values)
+        finally:
+            for raw_out in raw_outs:
+                raw_out.close()
+
+    stat_columns = [field['stat'] for field in fields]
+    for column, raw_file in zip(columns, raw_files):
+        raw = numpy.memmap(raw_file, dtype=numpy.float64, mode='r', shape=(count,)) if count else numpy.zeros(0)
+        chunks = [raw[start:start + chunk_rows] for start in range(0, count, chunk_rows)]
+
+        dtype = numpy.float64
+        # significance only holds small class values
+        if column in stat_columns and all(numpy.array_equal(chunk, numpy.round(chunk)) for chunk in chunks):
+            dtype = numpy.int16
+
+        column_file = os.path.join(points_dir, '%s.npy' % column)
+        if count:
+            part_file = '%s.part' % column_file
+            array = numpy.lib.format.open_memmap(part_file, mode='w+', dtype=dtype, shape=(count,))
+            for start, chunk in zip(range(0, count, chunk_rows), chunks):
+                array[start:start + len(chunk)] = chunk
+            array.flush()
+            del array
+            os.rename(part_file, column_file)
+        else:
+            save_array(column_file, numpy.zeros(0, dtype=dtype))
+
+        del raw, chunks
+        os.remove(raw_file)
+
+# the cached columns are memory-mapped, so opening them is cheap enough
+# to do in every worker process
+def open_points(points_dir, fields):
+    points = {}
+    for column in point_columns(fields):
+        points[column] = numpy.load(os.path.join(points_dir, '%s.npy' % column), mmap_mode='r')
+    return points
+
+## Sorts the points by longitude once, so that the points within any
+## extent can be found with a binary search instead of a full scan. The
+## index is stored alongside the cached columns
+def build_point_index(points_dir):
+    order_file = os.path.join(points_dir, 'index_order.npy')
+    lon_file = os.path.join(points_dir, 'index_lon.npy')
+    if not (os.path.exists(order_file) and os.path.exists(lon_file)):
+        lon = numpy.load(os.path.join(points_dir, 'LON.npy'), mmap_mode='r')
+        order = numpy.argsort(lon, kind='mergesort')
+        save_array(order_file, order)
+        save_array(lon_file, lon[order])
+
+def open_point_index(points_dir):
+    return {
+        'order': numpy.load(os.path.join(points_dir, 'index_order.npy'), mmap_mode='r'),
+        'lon': numpy.load(os.path.join(points_dir, 'index_lon.npy'), mmap_mode='r')
+    }
+
+# returns the ids of the points within the extent, in their original order
+def query_point_index(index, points, extent):
+    start = numpy.searchsorted(index['lon'], extent[0], side='left')
+    stop = numpy.searchsorted(index['lon'], extent[2], side='right')
+    candidates = index['order'][start:stop]
+    lat = points['LAT'][candidates]
+    return numpy.sort(candidates[(lat >= extent[1]) & (lat <= extent[3])])
+
+# Answers the boundary's extent from the point index. The selected ids
+# are saved for the gridding stage
+def extract_boundary_points(boundary, points_dir, fields):
+    points = open_points(points_dir, fields)
+    ids = query_point_index(open_point_index(points_dir), points, boundary['extent'])
+    save_array(boundary['points_ids_file'], ids)
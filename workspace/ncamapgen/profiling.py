@@ -0,0 +1,126 @@
+##
+## Profiling
+## With --profile, every task, the stages within the fused in-memory task
+## and every mapserv launch are measured in the process they run in. The
+## records are sent back to the main process along with the task's result
+## and written out as a report at the end of the run
+##
+import json, os, time, contextlib
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# the records taken in this process, or None when profiling is off
+profile_records = None
+
+def start_profile():
+    global profile_records
+    profile_records = []
+
+# hands over the records taken so far, so a worker only sends each once
+def take_profile_records():
+    global profile_records
+    if profile_records is None:
+        return []
+    records, profile_records = profile_records, []
+    return records
+
+# other modules go through these rather than importing profile_records,
+# which would bind the value it had at import
+def profile_enabled():
+    return profile_records is not None
+
+def add_profile_records(records):
+    if profile_records is not None:
+        profile_records.extend(records)
+
+# /proc/self/io counters, where the platform has them. rchar and wchar
+# count every byte read and written, including from the page cache
+def io_counters():
+    counters = {}
+    if os.path.exists('/proc/self/io'):
+        with open('/proc/self/io') as file_in:
+            for line in file_in:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    return counters
+
+def usage_snapshot(child):
+    snapshot = {'wall': time.time(), 'io': io_counters()}
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if child else resource.RUSAGE_SELF)
+        snapshot.update({'cpu': usage.ru_utime + usage.ru_stime, 'peak_rss_kb': usage.ru_maxrss})
+    return snapshot
+
+# Records the wall and CPU time, bytes read and written and the peak RSS of
+# the block, under a name of the form stage[:boundary[:field]]. With child
+# the CPU time and peak RSS are those of the subprocesses it waited for.
+# The peak RSS is the highest of the process (or its children) so far, as
+# that is all the OS keeps. Does nothing when profiling is off
+@contextlib.contextmanager
+def profile_stage(name, child=False):
+    if profile_records is None:
+        yield
+        return
+
+    start = usage_snapshot(child)
+    try:
+        yield
+    finally:
+        end = usage_snapshot(child)
+        labels = name.split('/')[-1].split(':')
+        record = {
+            'name': name,
+            'stage': labels[0],
+            'boundary': labels[1] if len(labels) > 1 else None,
+            'field': labels[2] if len(labels) > 2 else None,
+            'pid': os.getpid(),
+            'child': child,
+            'wall': end['wall'] - start['wall'],
+            'cpu': end.get('cpu', 0) - start.get('cpu', 0),
+            'peak_rss_kb': end.get('peak_rss_kb'),
+            'read_bytes': end['io'].get('rchar', 0) - start['io'].get('rchar', 0),
+            'write_bytes': end['io'].get('wchar', 0) - start['io'].get('wchar', 0)
+        }
+        profile_records.append(record)
+
+def summarize_records(records, key):
+    groups = {}
+    for record in records:
+        group = groups.setdefault(record[key], {
+            'count': 0, 'wall': 0.0, 'max_wall': 0.0, 'cpu': 0.0,
+            'peak_rss_kb': 0, 'read_bytes': 0, 'write_bytes': 0
+        })
+        group['count'] += 1
+        group['wall'] += record['wall']
+        group['max_wall'] = max(group['max_wall'], record['wall'])
+        group['cpu'] += record['cpu']
+        group['peak_rss_kb'] = max(group['peak_rss_kb'], record['peak_rss_kb'] or 0)
+        group['read_bytes'] += record['read_bytes']
+        group['write_bytes'] += record['write_bytes']
+    return groups
+
+# Writes the records, with totals per stage and per boundary, as JSON and
+# prints a per-stage summary. Stages nested in another (such as those of
+# the in-memory boundary task) are counted in both
+def write_profile(records, report_file, wall, jobs):
+    stages = summarize_records(records, 'stage')
+    boundaries = summarize_records([record for record in records if record['boundary']], 'boundary')
+    with open(report_file, 'w') as file_out:
+        json.dump({
+            'wall': wall,
+            'jobs': jobs,
+            'stages': stages,
+            'boundaries': boundaries,
+            'records': records
+        }, file_out, indent=2, sort_keys=True)
+
+    print('%-14s %6s %10s %10s %10s %10s %10s %10s' % (
+        'stage', 'count', 'wall s', 'max s', 'cpu s', 'rss MB', 'read MB', 'write MB'))
+    for stage in sorted(stages, key=lambda name: -stages[name]['wall']):
+        group = stages[stage]
+        print('%-14s %6d %10.2f %10.2f %10.2f %10.1f %10.1f %10.1f' % (
+            stage, group['count'], group['wall'], group['max_wall'], group['cpu'],
+            group['peak_rss_kb'] / 1024.0, group['read_bytes'] / 1048576.0, group['write_bytes'] / 1048576.0))
+    print('%d records over %.2f s with %d job(s), written to %s' % (len(records), wall, jobs, report_file))
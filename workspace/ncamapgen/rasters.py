@@ -0,0 +1,436 @@
+##
+## Rasters
+## Gridding the points, writing and interpolating the rasters, baking in
+## the classes and drawing the significance overlay
+##
+import os, re, math
+import numpy
+from osgeo import ogr, gdal
+
+from .common import NODATA, TILED_OPTIONS, image_scale, render_grid_size, gdal_driver, ogr_driver, spatial_ref
+from .boundaries import project_shapefile
+from .points import open_points
+
+# Bins the selected points into a grid of xres by yres cells, centered
+# on the points themselves. All columns are scattered in one pass;
+# returns the grids keyed by column, the geotransform and a mask of the
+# cells that received a point, or None if no points were selected
+def grid_points(points, ids, xres, yres, columns):
+    if len(ids) == 0:
+        return None
+
+    x = points['LON'][ids]
+    y = points['LAT'][ids]
+    min_x = x.min()
+    max_y = y.max()
+    width = int(round((x.max() - min_x) / xres)) + 1
+    height = int(round((max_y - y.min()) / yres)) + 1
+
+    cols = numpy.floor((x - min_x) / xres + 0.5).astype(int)
+    rows = numpy.floor((max_y - y) / yres + 0.5).astype(int)
+
+    # gdal_rasterize initializes to 0 and lets later points overwrite
+    # earlier ones in the same cell; plain fancy assignment does the same
+    values = numpy.vstack([points[column][ids] for column in columns])
+    cells = numpy.zeros((len(columns), height * width))
+    cells[:, rows * width + cols] = values
+    filled = numpy.zeros(height * width, dtype=bool)
+    filled[rows * width + cols] = True
+
+    grids = {}
+    for i, column in enumerate(columns):
+        grids[column] = cells[i].reshape(height, width)
+
+    geotransform = (min_x - xres / 2.0, xres, 0, max_y + yres / 2.0, 0, -yres)
+
+    return grids, geotransform, filled.reshape(height, width)
+
+# halves the size at every level until it would be smaller than a tile
+def overview_levels(width, height, min_size=256):
+    levels = []
+    level = 2
+    while max(width, height) // level >= min_size:
+        levels.append(level)
+        level *= 2
+    return levels
+
+# With overviews, an internal pyramid is built so that readers of a
+# smaller size (MapServer picks the level through GDAL) only read and
+# resample the level closest to what they need. With cog_compress, the
+# raster is written as a compressed Cloud-Optimized GeoTIFF instead
+def write_raster(path, grid, geotransform, nodata=None, options=(), overviews=False,
+                 data_type=gdal.GDT_Float64, colors=None, resampling='AVERAGE', cog_compress=None, srs='EPSG:4326'):
+    if cog_compress:
+        driver = gdal_driver('MEM')
+        dataset = driver.Create('', grid.shape[1], grid.shape[0], 1, data_type)
+    else:
+        driver = gdal_driver('GTiff')
+        dataset = driver.Create(path, grid.shape[1], grid.shape[0], 1, data_type, list(options))
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(spatial_ref(srs).ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    # colors is a list of RGBA tuples, one per pixel value
+    if colors is not None:
+        color_table = gdal.ColorTable()
+        for i, color in enumerate(colors):
+            color_table.SetColorEntry(i, tuple(color))
+        band.SetRasterColorTable(color_table)
+        band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+    band.WriteArray(grid)
+    if cog_compress:
+        write_cog(path, dataset, data_type, cog_compress, resampling)
+        return
+    if overviews:
+        levels = overview_levels(grid.shape[1], grid.shape[0])
+        if levels:
+            dataset.BuildOverviews(resampling, levels)
+    # dereference to flush to disk
+    dataset = None
+
+# Copies the dataset into a Cloud-Optimized GeoTIFF: 256 pixel tiles,
+# compressed with a predictor, with overviews, laid out so that a reader
+# can fetch any tile or level with a range request. GDAL builds without
+# the COG driver (before 3.1) get the same layout from GTiff, by copying
+# overviews built on the source
+def write_cog(path, dataset, data_type, compress, resampling):
+    floating = data_type in (gdal.GDT_Float32, gdal.GDT_Float64)
+    if gdal_driver('COG') is not None:
+        options = ['COMPRESS=%s' % compress,
+                   'PREDICTOR=%s' % ('FLOATING_POINT' if floating else 'STANDARD'),
+                   'BLOCKSIZE=256',
+                   'OVERVIEWS=AUTO',
+                   'RESAMPLING=%s' % resampling]
+        gdal_driver('COG').CreateCopy(path, dataset, options=options)
+        return
+
+    levels = overview_levels(dataset.RasterXSize, dataset.RasterYSize)
+    if levels:
+        dataset.BuildOverviews(resampling, levels)
+    options = TILED_OPTIONS + ['COMPRESS=%s' % compress,
+                               'PREDICTOR=%d' % (3 if floating else 2),
+                               'COPY_SRC_OVERVIEWS=YES']
+    gdal_driver('GTiff').CreateCopy(path, dataset, options=options)
+
+def generate_rasters(geo_file, points_dir, fields, xres, yres, source_nodata, cog_compress=None):
+    points = open_points(points_dir, fields)
+    ids = numpy.load(geo_file['points_ids_file'])
+    write_grids(geo_file, points, ids, xres, yres, source_nodata, cog_compress)
+
+# Cells without a point, or holding the source's nodata sentinel
+# (source_nodata, such as -99.999), are set to NODATA in the data grids.
+# The stat grids only hold significance classes, so they are bytes, with
+# 0 where there is no point. With cog_compress, the data grids are
+# written as Float32 Cloud-Optimized GeoTIFFs. A boundary that holds no
+# points has nothing to interpolate or render, so it is an error
+def write_grids(geo_file, points, ids, xres, yres, source_nodata, cog_compress=None):
+    columns = []
+    for raster in geo_file['rasters']:
+        columns.append(raster['field'])
+        columns.append(raster['stat_field'])
+
+    gridded = grid_points(points, ids, xres, yres, columns)
+    if gridded is None:
+        raise ValueError('No source points fall within boundary %s' % geo_file['boundary_file_name'])
+    grids, geotransform, filled = gridded
+
+    for raster in geo_file['rasters']:
+        grid = grids[raster['field']]
+        missing = ~filled
+        if source_nodata is not None:
+            missing |= numpy.isclose(grid, source_nodata)
+        grid[missing] = NODATA
+        if cog_compress:
+            write_raster(raster['grid_file'], grid, geotransform, NODATA, data_type=gdal.GDT_Float32,
+                         cog_compress=cog_compress)
+        else:
+            write_raster(raster['grid_file'], grid, geotransform, NODATA)
+        write_raster(raster['stat_grid'], grids[raster['stat_field']], geotransform, 0, data_type=gdal.GDT_Byte)
+
+def cubic_weight(t, a=-0.5):
+    t = numpy.abs(t)
+    return numpy.where(t <= 1,
+                       (a + 2) * t ** 3 - (a + 3) * t ** 2 + 1,
+                       numpy.where(t < 2, a * t ** 3 - 5 * a * t ** 2 + 8 * a * t - 4 * a, 0))
+
+# Source pixel indices and weights of the kernel taps for each output
+# position, with positions given in fractional source pixels. Taps past
+# the edge are clamped to the edge pixel
+def kernel_taps(positions, size, method):
+    base = numpy.floor(positions).astype(int)
+    frac = positions - base
+
+    if method == 'bilinear':
+        offsets = [0, 1]
+        weights = [1 - frac, frac]
+    elif method == 'bicubic':
+        offsets = [-1, 0, 1, 2]
+        weights = [cubic_weight(1 + frac), cubic_weight(frac), cubic_weight(1 - frac), cubic_weight(2 - frac)]
+    else:
+        raise ValueError('Unknown interpolation method: %s' % method)
+
+    indices = [numpy.clip(base + offset, 0, size - 1) for offset in offsets]
+    return indices, weights
+
+# Resamples the grid to width x height over the same extent. Taps on
+# invalid cells are dropped and the remaining weights renormalized, so
+# nodata never bleeds into the result. Returns the result and a mask of
+# the output pixels that had any valid taps. Bicubic falls back to
+# bilinear wherever any of its taps are invalid, since its negative
+# lobes make renormalizing unstable
+def resample_grid(grid, valid, width, height, method):
+    rows = (numpy.arange(height) + 0.5) * grid.shape[0] / float(height) - 0.5
+    cols = (numpy.arange(width) + 0.5) * grid.shape[1] / float(width) - 0.5
+    row_indices, row_weights = kernel_taps(rows, grid.shape[0], method)
+    col_indices, col_weights = kernel_taps(cols, grid.shape[1], method)
+
+    # the kernel is separable, so filter along the rows first and then
+    # down the columns of that
+    values = numpy.where(valid, grid, 0.0)
+    partial_total = numpy.zeros((grid.shape[0], width))
+    partial_weight = numpy.zeros((grid.shape[0], width))
+    partial_complete = numpy.ones((grid.shape[0], width), dtype=bool)
+    for col_index, col_weight in zip(col_indices, col_weights):
+        partial_total += col_weight * values[:, col_index]
+        partial_weight += col_weight * valid[:, col_index]
+        partial_complete &= valid[:, col_index]
+
+    total = numpy.zeros((height, width))
+    weight = numpy.zeros((height, width))
+    complete = numpy.ones((height, width), dtype=bool)
+    for row_index, row_weight in zip(row_indices, row_weights):
+        total += row_weight[:, None] * partial_total[row_index]
+        weight += row_weight[:, None] * partial_weight[row_index]
+        complete &= partial_complete[row_index]
+
+    result_valid = weight > 1e-6
+    result = numpy.where(result_valid, total / numpy.where(result_valid, weight, 1), 0.0)
+
+    if method != 'bilinear' and not complete.all():
+        fallback, fallback_valid = resample_grid(grid, valid, width, height, 'bilinear')
+        result = numpy.where(complete, result, fallback)
+        result_valid = numpy.where(complete, result_valid, fallback_valid)
+
+    return result, result_valid
+
+# The interpolation covers the grid's extent at the resolution the
+# boundary is rendered at, per image_scale, so only pixels that will
+# actually be drawn are computed
+def interpolate_raster(raster, render_extent, render_max, method):
+    dataset = gdal.Open(raster['grid_file'])
+    band = dataset.GetRasterBand(1)
+    grid = band.ReadAsArray().astype(numpy.float64)
+    geotransform = dataset.GetGeoTransform()
+    nodata = band.GetNoDataValue()
+    dataset = None
+
+    valid = numpy.ones(grid.shape, dtype=bool)
+    if nodata is not None:
+        valid = grid != nodata
+
+    width, height, interpolation_geotransform = render_grid(grid.shape, geotransform, render_extent, render_max)
+    result, result_valid = resample_grid(grid, valid, width, height, method)
+    result[~result_valid] = NODATA
+
+    # only classify_raster reads it, at full size, so it needs no overviews;
+    # the classified raster is the one drawn at smaller sizes
+    write_raster(raster['interpolation_file'], result, interpolation_geotransform, NODATA, TILED_OPTIONS)
+
+CLASS_OPERATORS = {
+    '<': numpy.less,
+    '<=': numpy.less_equal,
+    '>': numpy.greater,
+    '>=': numpy.greater_equal,
+    '=': numpy.equal,
+    '==': numpy.equal
+}
+
+# a [pixel] comparison with a number, optionally in parentheses
+CLASS_COMPARISON = re.compile(r'\(?\s*\[pixel\]\s*(>=|<=|==|>|<|=)\s*(-?(?:\d+\.?\d*|\.\d+))\s*\)?$', re.I)
+
+# Parses the CLASS blocks of a MapServer classes file, like classes.cmap,
+# into a list of classes, each with the (operator, value) comparisons of
+# its EXPRESSION on [pixel] and the RGB of its COLOR. Only comparisons of
+# [pixel] with a number, ANDed together, are understood; anything else
+# would be classified differently than MapServer does, so it is an error.
+# A class without an EXPRESSION matches every pixel, as in MapServer
+def parse_classes(cmap_path):
+    with open(cmap_path) as file_in:
+        text = re.sub(r'#[^\n]*', '', file_in.read())
+
+    classes = []
+    for number, block in enumerate(re.split(r'\bCLASS\b', text, flags=re.I)[1:], 1):
+        name = re.search(r'\bNAME\s+"([^"]*)"', block, re.I)
+        label = 'class %d%s of %s' % (number, ' (%s)' % name.group(1) if name else '', cmap_path)
+
+        conditions = []
+        expression = re.search(r'\bEXPRESSION\s+(.*)', block, re.I)
+        if expression:
+            source = expression.group(1).strip()
+            if not (source.startswith('(') and source.endswith(')')):
+                raise ValueError('Unsupported EXPRESSION in %s: %s' % (label, source))
+            for term in re.split(r'\bAND\b|&&', source[1:-1], flags=re.I):
+                comparison = CLASS_COMPARISON.match(term.strip())
+                if comparison is None:
+                    raise ValueError('Unsupported EXPRESSION in %s: %s' % (label, source))
+                conditions.append((comparison.group(1), float(comparison.group(2))))
+
+        color = re.search(r'\bCOLOR\s+(\d+)\s+(\d+)\s+(\d+)', block, re.I)
+        if color is None:
+            raise ValueError('No COLOR in %s' % label)
+        classes.append({
+            'conditions': conditions,
+            'color': tuple(int(channel) for channel in color.groups())
+        })
+
+    return classes
+
+# Returns the 1-based index of the first class each valid pixel falls in,
+# as MapServer picks the first matching class; 0 is unclassified
+def classify_pixels(values, valid, classes):
+    index = numpy.zeros(values.shape, dtype=numpy.uint8)
+    unclassified = valid.copy()
+    for i, pixel_class in enumerate(classes):
+        match = unclassified.copy()
+        for operator, value in pixel_class['conditions']:
+            match &= CLASS_OPERATORS[operator](values, value)
+        index[match] = i + 1
+        unclassified &= ~match
+    return index
+
+# RGBA color table for classify_pixels' indices
+def class_colors(classes):
+    colors = [(0, 0, 0, 0)]
+    for pixel_class in classes:
+        colors.append(tuple(pixel_class['color']) + (255,))
+    return colors
+
+# the color table of a paletted raster, such as classify_raster's, as RGBA
+def color_table(path):
+    dataset = gdal.Open(path)
+    table = dataset.GetRasterBand(1).GetColorTable()
+    return numpy.array([table.GetColorEntry(i) for i in range(table.GetCount())], dtype=numpy.uint8)
+
+# Bakes classes.cmap into the interpolation: each pixel is replaced by the
+# index of its class, with the class colors as the color table, so that
+# MapServer draws it as is instead of evaluating every class expression
+# against every pixel. 0 is nodata and transparent
+def classify_raster(raster, classes):
+    dataset = gdal.Open(raster['interpolation_file'])
+    values = dataset.GetRasterBand(1).ReadAsArray()
+    geotransform = dataset.GetGeoTransform()
+    dataset = None
+
+    classified = classify_pixels(values, values != NODATA, classes)
+    # averaging would blend class indices, so overviews pick a pixel
+    write_raster(raster['classified_file'], classified, geotransform, 0, TILED_OPTIONS, overviews=True,
+                 data_type=gdal.GDT_Byte, colors=class_colors(classes), resampling='NEAREST')
+
+# Size and geotransform of a grid's extent at the pixel size of the
+# boundary's render, per image_scale
+def render_grid(shape, geotransform, render_extent, render_max):
+    image_dimensions = image_scale(render_extent, render_max)
+    pixel_width = (render_extent[2] - render_extent[0]) / image_dimensions['width']
+    pixel_height = (render_extent[3] - render_extent[1]) / image_dimensions['height']
+    width = max(1, int(math.ceil(shape[1] * geotransform[1] / pixel_width)))
+    height = max(1, int(math.ceil(shape[0] * -geotransform[5] / pixel_height)))
+
+    render_geotransform = (geotransform[0],
+                           geotransform[1] * shape[1] / float(width),
+                           0,
+                           geotransform[3],
+                           0,
+                           geotransform[5] * shape[0] / float(height))
+
+    return width, height, render_geotransform
+
+# Produces the significance overlay straight from the stat grid, at the
+# render resolution, as a paletted raster: cells with a significance of
+# 3 get the same 45 degree hatch lines the hatch symbol draws, those of 2
+# are filled white and everything else is transparent
+def hatch_stat(raster, render_extent, render_max, spacing=25):
+    dataset = gdal.Open(raster['stat_grid'])
+    stat = dataset.GetRasterBand(1).ReadAsArray()
+    geotransform = dataset.GetGeoTransform()
+    dataset = None
+
+    width, height, hatch_geotransform = render_grid(stat.shape, geotransform, render_extent, render_max)
+
+    # nearest neighbour, so the overlay keeps the cell edges
+    rows = ((numpy.arange(height) + 0.5) * stat.shape[0] / float(height)).astype(int)
+    cols = ((numpy.arange(width) + 0.5) * stat.shape[1] / float(width)).astype(int)
+    sig = stat[rows[:, None], cols[None, :]]
+
+    write_raster(raster['stat_hatch'], hatch_pixels(sig, spacing), hatch_geotransform, 0, TILED_OPTIONS,
+                 data_type=gdal.GDT_Byte, colors=HATCH_COLORS)
+
+# 0 is transparent, 1 a hatch line and 2 the white fill
+HATCH_COLORS = [(0, 0, 0, 0), (0, 0, 0, 255), (255, 255, 255, 255)]
+
+# origin is the row and column of sig's top left pixel in a larger image,
+# so that the lines of adjoining pieces of it meet. spacing is the distance
+# between the lines across them, as the hatch symbol's SIZE is; along a row
+# they are spacing * sqrt(2) pixels apart
+def hatch_pixels(sig, spacing=25, origin=(0, 0)):
+    height, width = sig.shape
+    period = int(round(spacing * math.sqrt(2)))
+    lines = (numpy.arange(origin[0], origin[0] + height)[:, None] +
+             numpy.arange(origin[1], origin[1] + width)[None, :]) % period == 0
+    hatch = numpy.zeros((height, width), dtype=numpy.uint8)
+    hatch[(sig == 3) & lines] = 1
+    hatch[sig == 2] = 2
+    return hatch
+
+def polygonize_stat(raster):
+    grid = gdal.Open(raster['stat_grid'])
+    band = grid.GetRasterBand(1)
+    driver = ogr_driver('ESRI Shapefile')
+    if os.path.exists(raster['stat_shp']):
+        driver.DeleteDataSource(raster['stat_shp'])
+    outshp = driver.CreateDataSource(raster['stat_shp'])
+    outlr = outshp.CreateLayer('poly', srs = spatial_ref('EPSG:4326'))
+    outlr.CreateField(ogr.FieldDefn('sig', ogr.OFTInteger))
+    gdal.Polygonize(band, None, outlr, 0, [], callback=None)
+
+##
+## Projected rasters
+## For renders in another srs than 4326, the classified raster and the
+## significance overlay are projected once onto the grid of the render
+## itself, per render_grid_size, so that MapServer and the compositor draw
+## them pixel for pixel rather than reprojecting them for every image
+##
+def image_geotransform(extent, width, height):
+    return (extent[0], (extent[2] - extent[0]) / float(width), 0,
+            extent[3], 0, -(extent[3] - extent[1]) / float(height))
+
+# reads a raster onto the image grid, reprojecting it if the image is in
+# another srs; GDAL uses the raster's overviews where the image is smaller
+def warp_onto(path, extent, width, height, nodata, srs=None):
+    dataset = gdal.Warp('', path,
+                        format='MEM',
+                        outputBounds=(extent[0], extent[1], extent[2], extent[3]),
+                        width=width,
+                        height=height,
+                        resampleAlg='near',
+                        dstNodata=nodata,
+                        dstSRS=srs)
+    return dataset.GetRasterBand(1).ReadAsArray()
+
+def project_raster(raster, render_extent, render_max, srs, stat_overlay, spacing=25):
+    extent, width, height = render_grid_size(render_extent, srs, render_max)
+    geotransform = image_geotransform(extent, width, height)
+
+    classified = warp_onto(raster['classified_file'], extent, width, height, 0, srs)
+    write_raster(raster['projected_file'], classified, geotransform, 0, TILED_OPTIONS, overviews=True,
+                 data_type=gdal.GDT_Byte, colors=color_table(raster['classified_file']), resampling='NEAREST',
+                 srs=srs)
+
+    # the hatch lines are drawn in the render's pixels, so they stay at 45
+    # degrees rather than being bent by the projection
+    if stat_overlay == 'raster':
+        sig = warp_onto(raster['stat_grid'], extent, width, height, 0, srs)
+        write_raster(raster['projected_hatch'], hatch_pixels(sig, spacing), geotransform, 0, TILED_OPTIONS,
+                     data_type=gdal.GDT_Byte, colors=HATCH_COLORS, srs=srs)
+    else:
+        project_shapefile(raster['stat_shp'], raster['projected_stat_shp'], srs)
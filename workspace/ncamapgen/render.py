@@ -0,0 +1,453 @@
+##
+## Render
+## The mapfile and the render backends: MapServer through mapscript or
+## the mapserv binary, or the NumPy compositor
+##
+import os, re, subprocess
+import numpy
+from osgeo import ogr, gdal
+try:
+    import mapscript
+except ImportError:
+    mapscript = None
+
+from .common import file_hash, files_hash, render_grid_size, spatial_ref, gdal_driver, ogr_driver
+from .profiling import profile_stage
+from .rasters import parse_classes, color_table, image_geotransform, warp_onto, HATCH_COLORS, hatch_pixels
+
+MAPSERV = './mapserv-6.4.1-CentOS-7.exe'
+
+# reads the map template once, along with a hash of it and the classes
+# file next to it, parsed for classify_raster
+def load_template(map_template):
+    with open(map_template) as file_in:
+        text = file_in.read()
+    classes_file = os.path.join(os.path.dirname(map_template), 'classes.cmap')
+
+    return {
+        'path': map_template,
+        'text': text,
+        'classes': parse_classes(classes_file),
+        'key': files_hash([map_template, classes_file])
+    }
+
+# line widths of the boundary and highlight outlines, in pixels
+def render_style(config):
+    return {
+        'boundary_width': config.get('boundary_width', 3),
+        'highlight_width': config.get('highlight_width', 8)
+    }
+
+# stat_overlay picks whether the significance layer draws the polygonized
+# stats with hatch classes, or the pre-hatched paletted raster. Each
+# boundary's highlights get a layer of their own, drawn only when asked for.
+# The layers draw the copies of the data projected into srs
+def build_mapfile(geo_files, template, output_map, stat_overlay='polygons', style=None, srs='EPSG:4326'):
+    style = style or render_style({})
+    mask_base = '''
+  LAYER
+    NAME "%s_mask"
+    DATA "%s"
+    TYPE POLYGON
+    STATUS OFF
+    CLASS
+      STYLE
+        COLOR 255 255 255
+      END
+    END
+    PROJECTION
+      "init=epsg:4326"
+    END
+  END
+'''
+
+    boundary_base = '''
+  LAYER
+    NAME "%s_boundary"
+    DATA "%s"
+    TYPE POLYGON
+    STATUS ON
+    CLASS
+      STYLE
+        OUTLINECOLOR 0 0 0
+        WIDTH %s
+        ANTIALIAS TRUE
+      END
+    END
+    PROJECTION
+      "init=epsg:4326"
+    END
+  END
+'''
+
+    highlight_base = '''
+  LAYER
+    NAME "%s"
+    DATA "%s"
+    TYPE POLYGON
+    STATUS ON
+    CLASS
+      STYLE
+        OUTLINECOLOR 0 0 0
+        WIDTH %s
+        ANTIALIAS TRUE
+      END
+    END
+    PROJECTION
+      "init=epsg:4326"
+    END
+  END
+'''
+
+    # pre-classified by classify_raster, drawn with its own color table
+    layer_base =  '''
+  LAYER
+    NAME "%s"
+    DATA "%s"
+    STATUS ON
+    TYPE RASTER
+    MASK "%s_mask"
+    PROJECTION
+      "init=epsg:4326"
+    END
+  END
+'''
+
+    stat_polygon_base = '''
+  LAYER
+    NAME "%s"
+    DATA "%s"
+    TYPE POLYGON
+    STATUS ON
+    CLASS
+      EXPRESSION ([sig] = 3)
+      STYLE
+        SYMBOL "hatch"
+        COLOR 0 0 0
+        ANGLE 45
+        SIZE 25
+        WIDTH 0.75
+      END
+    END
+    CLASS
+      EXPRESSION ([sig] = 2)
+      STYLE
+        COLOR 255 255 255
+      END
+    END
+    MASK "%s_mask"
+    PROJECTION
+      "init=epsg:4326"
+    END
+  END
+'''
+
+    # drawn with its own color table, nodata is transparent
+    stat_raster_base = '''
+  LAYER
+    NAME "%s"
+    DATA "%s"
+    TYPE RASTER
+    STATUS ON
+    MASK "%s_mask"
+    PROJECTION
+      "init=epsg:4326"
+    END
+  END
+'''
+
+    layers = []
+    for geo_file in geo_files:
+        geo_file, _ = projected_layers(geo_file, None, srs)
+        mask_name = geo_file['boundary_file_name']
+        layers.append(mask_base % (mask_name, os.path.abspath(geo_file['render_boundary_file'])))
+        layers.append(boundary_base % (mask_name, os.path.abspath(geo_file['render_boundary_file']),
+                                       style['boundary_width']))
+
+        for highlight in geo_file['highlight_files']:
+            layers.append(highlight_base % (highlight['key'], os.path.abspath(highlight['path']),
+                                            style['highlight_width']))
+
+        for raster in geo_file['rasters']:
+            _, raster = projected_layers(geo_file, raster, srs)
+            layers.append(
+                layer_base % (
+                    raster['grid_layer_name'],
+                    os.path.abspath(raster['classified_file']),
+                    #os.path.abspath(raster['grid_file']), 
+                    mask_name))
+
+            if stat_overlay == 'raster':
+                layers.append(stat_raster_base % (raster['stat_layer_name'], os.path.abspath(raster['stat_hatch']), mask_name))
+            else:
+                layers.append(stat_polygon_base % (raster['stat_layer_name'], os.path.abspath(raster['stat_shp']), mask_name))
+
+    # renamed into place, so a worker never loads it half written
+    part_file = '%s.%d.part' % (output_map, os.getpid())
+    with open(part_file, 'wt') as file_out:
+        file_out.write(template.replace('$$LAYERS$$',
+                                        ''.join(layers).replace('"init=epsg:4326"', '"init=%s"' % srs.lower())))
+    os.rename(part_file, output_map)
+
+# The boundary and raster with the paths of their copies projected into
+# srs, if it isn't 4326, so that they are drawn without reprojecting. The
+# raster can be left out
+def projected_layers(geo_file, raster, srs):
+    if srs.upper() == 'EPSG:4326':
+        return geo_file, raster
+    geo_file = dict(geo_file,
+                    render_boundary_file=geo_file['projected_boundary_file'],
+                    highlight_files=[dict(highlight, path=highlight['projected_path'])
+                                     for highlight in geo_file['highlight_files']])
+    if raster is not None:
+        raster = dict(raster,
+                      classified_file=raster['projected_file'],
+                      stat_hatch=raster['projected_hatch'],
+                      stat_shp=raster['projected_stat_shp'])
+    return geo_file, raster
+
+# mapfiles already parsed by this process, with the hash of what was read.
+# Two rewrites within the filesystem's mtime resolution, as on some network
+# filesystems, would look unchanged by mtime alone
+loaded_maps = {}
+
+# Picks how images are rendered: 'mapscript' keeps each mapfile loaded
+# in-process, 'cgi' runs the mapserv binary per image and 'numpy'
+# composites the image without MapServer. 'auto' prefers mapscript when
+# it is installed
+def render_backend(config):
+    backend = config.get('render_backend', 'auto')
+    if backend == 'auto':
+        backend = 'mapscript' if mapscript is not None else 'cgi'
+    if backend not in ('mapscript', 'cgi', 'numpy'):
+        raise ValueError('Unknown render_backend: %s' % backend)
+    if backend == 'mapscript' and mapscript is None:
+        raise ValueError('render_backend is mapscript, but the mapscript module is not installed')
+    return backend
+
+def load_map(mapfile):
+    key = file_hash(mapfile)
+    if mapfile not in loaded_maps or loaded_maps[mapfile][0] != key:
+        loaded_maps[mapfile] = (key, mapscript.mapObj(mapfile))
+    return loaded_maps[mapfile][1]
+
+# renders from a copy of the already loaded map, since applying the
+# request changes layer status, extent and size
+def render_mapscript(mapfile, query_string, output):
+    map_obj = load_map(mapfile).clone()
+    request = mapscript.OWSRequest()
+    request.loadParamsFromURL(query_string)
+    map_obj.loadOWSParameters(request)
+    image = map_obj.draw()
+    image.save(output)
+
+def render_cgi(query_string, output):
+    env = dict(os.environ)
+    env['REQUEST_METHOD'] = 'GET'
+    env['QUERY_STRING'] = query_string
+
+    process = subprocess.Popen([MAPSERV], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    response, errors = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('mapserv exited with %s: %s' % (process.returncode, errors))
+
+    # the CGI headers end at the first blank line
+    parts = re.split(b'\r?\n\r?\n', response, 1)
+    if len(parts) != 2 or b'image/' not in parts[0].lower():
+        raise RuntimeError('mapserv did not return an image: %s' % response[:500])
+
+    with open(output, 'wb') as out:
+        out.write(parts[1])
+
+##
+## NumPy compositor
+##
+# the layer's features are reprojected if the image is in another srs
+def rasterize_onto(layer, extent, width, height, options=(), srs=None):
+    dataset = gdal_driver('MEM').Create('', width, height, 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform(image_geotransform(extent, width, height))
+    dataset.SetProjection(spatial_ref(srs or 'EPSG:4326').ExportToWkt())
+    gdal.RasterizeLayer(dataset, [1], layer, burn_values=[1], options=list(options))
+    return dataset.GetRasterBand(1).ReadAsArray()
+
+# rasterizes the outlines of the layer's polygons
+def rasterize_outline(layer, extent, width, height, srs=None):
+    memory = ogr_driver('Memory').CreateDataSource('')
+    outline = memory.CreateLayer('outline', srs = layer.GetSpatialRef(), geom_type = ogr.wkbMultiLineString)
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is not None:
+            line = ogr.Feature(outline.GetLayerDefn())
+            line.SetGeometry(geometry.Boundary())
+            outline.CreateFeature(line)
+    layer.ResetReading()
+    return rasterize_onto(outline, extent, width, height, ['ALL_TOUCHED=TRUE'], srs)
+
+# grows the mask by radius pixels in every direction
+def dilate(mask, radius):
+    height, width = mask.shape
+    grown = mask.copy()
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            grown[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] |= \
+                mask[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+    return grown
+
+def write_png(path, image):
+    memory = gdal_driver('MEM').Create('', image.shape[1], image.shape[0], 4, gdal.GDT_Byte)
+    for band in range(4):
+        memory.GetRasterBand(band + 1).WriteArray(image[:, :, band])
+    gdal_driver('PNG').CreateCopy(path, memory)
+
+# reads a rendered PNG as RGBA, whichever of paletted, RGB or RGBA it is
+def read_image(path):
+    dataset = gdal.Open(path)
+    band = dataset.GetRasterBand(1)
+    if dataset.RasterCount == 1 and band.GetColorTable() is not None:
+        return color_table(path)[band.ReadAsArray()]
+    bands = [dataset.GetRasterBand(i + 1).ReadAsArray() for i in range(dataset.RasterCount)]
+    if len(bands) < 3:
+        bands = [bands[0]] * 3 + bands[1:]
+    if len(bands) == 3:
+        bands.append(numpy.full(bands[0].shape, 255, dtype=numpy.uint8))
+    return numpy.dstack(bands[:4]).astype(numpy.uint8)
+
+# Draws the RGBA overlay over the RGBA base, as the layers of one render
+# would have been drawn over each other
+def alpha_composite(base, overlay):
+    alpha = overlay[:, :, 3:].astype(numpy.float32) / 255
+    base_alpha = base[:, :, 3:].astype(numpy.float32) / 255
+    out_alpha = alpha + base_alpha * (1 - alpha)
+    color = overlay[:, :, :3] * alpha + base[:, :, :3] * base_alpha * (1 - alpha)
+    color /= numpy.maximum(out_alpha, 1e-6)
+    return numpy.dstack([color, out_alpha * 255]).round().astype(numpy.uint8)
+
+# The significance overlay as HATCH_COLORS indices, hatched in the image's
+# own pixels, from the stat polygons or straight from the stat grid, so
+# that the lines keep their spacing at any image size. The pre-hatched
+# stat_hatch raster only has it at the boundary's render size
+def stat_pixels(raster, extent, width, height, stat_overlay, srs=None, origin=(0, 0)):
+    if stat_overlay == 'raster':
+        sig = warp_onto(raster['stat_grid'], extent, width, height, 0, srs)
+    else:
+        stat_source = ogr_driver('ESRI Shapefile').Open(raster['stat_shp'], 0)
+        sig = rasterize_onto(stat_source.GetLayer(), extent, width, height, ['ATTRIBUTE=sig'], srs)
+    return hatch_pixels(sig, origin=origin)
+
+# Draws the same composition as the mapfile layers: the classified
+# interpolation, the significance hatch and white fill, both masked to
+# the boundary, and the boundary outline on top. The extent is in srs,
+# 4326 by default; origin places the image in a larger one for the hatch
+# lines, as in hatch_pixels
+def composite(geo_file, raster, extent, width, height, stat_overlay, srs=None, origin=(0, 0), style=None):
+    style = style or render_style({})
+    driver = ogr_driver('ESRI Shapefile')
+    boundary_source = driver.Open(geo_file['render_boundary_file'], 0)
+    boundary_layer = boundary_source.GetLayer()
+    mask = rasterize_onto(boundary_layer, extent, width, height, srs=srs).astype(bool)
+
+    classified = warp_onto(raster['classified_file'], extent, width, height, 0, srs)
+    classified[~mask] = 0
+    image = color_table(raster['classified_file'])[classified]
+
+    overlay = stat_pixels(raster, extent, width, height, stat_overlay, srs, origin)
+    overlay[~mask] = 0
+    image[overlay == 1] = HATCH_COLORS[1]
+    image[overlay == 2] = HATCH_COLORS[2]
+
+    outline = dilate(rasterize_outline(boundary_layer, extent, width, height, srs).astype(bool),
+                     style['boundary_width'] // 2)
+    image[outline] = (0, 0, 0, 255)
+
+    return image
+
+# the highlight's outline alone, on a transparent image
+def composite_highlight(highlight, extent, width, height, srs=None, style=None):
+    style = style or render_style({})
+    source = ogr_driver('ESRI Shapefile').Open(highlight['path'], 0)
+    outline = dilate(rasterize_outline(source.GetLayer(), extent, width, height, srs).astype(bool),
+                     style['highlight_width'] // 2)
+    image = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    image[outline] = (0, 0, 0, 255)
+    return image
+
+# the outputs of the raster's render: the plain one, and one per highlight
+# of its boundary
+def render_outputs(geo_file, raster):
+    return [raster['render_file']] + [raster['highlight_render_files'][highlight['name']]
+                                      for highlight in geo_file['highlight_files']]
+
+# Renders the raster over its boundary's render extent, projected into
+# srs if that isn't 4326, from the layers already projected into it. The
+# highlighted renders are that same image with each highlight's overlay,
+# from render_highlight, composited over it rather than rendered again
+def render_image(mapfile, geo_file, raster, render_max, backend, stat_overlay='polygons', srs='EPSG:4326',
+                 style=None):
+    extent, width, height = render_grid_size(geo_file['render_extent'], srs, render_max)
+    geo_file, raster = projected_layers(geo_file, raster, srs)
+
+    if backend == 'numpy':
+        image = composite(geo_file, raster, extent, width, height, stat_overlay, srs, style=style)
+        write_png(raster['render_file'], image)
+    else:
+        render_map(map_query(mapfile, geo_file, raster, extent, width, height, srs), mapfile,
+                   '%s:%s' % (geo_file['boundary_file_name'], raster['field']), backend, raster['render_file'])
+        if geo_file['highlight_files']:
+            image = read_image(raster['render_file'])
+
+    for highlight in geo_file['highlight_files']:
+        overlay = read_image(geo_file['highlight_overlay_files'][highlight['name']])
+        write_png(raster['highlight_render_files'][highlight['name']], alpha_composite(image, overlay))
+
+# Renders one highlight's outline on its own as a transparent overlay,
+# once per boundary, for render_image to composite over every field's
+# render of it
+def render_highlight(mapfile, geo_file, highlight_name, render_max, backend, srs='EPSG:4326', style=None):
+    extent, width, height = render_grid_size(geo_file['render_extent'], srs, render_max)
+    geo_file, _ = projected_layers(geo_file, None, srs)
+    highlight = [current for current in geo_file['highlight_files'] if current['name'] == highlight_name][0]
+    output = geo_file['highlight_overlay_files'][highlight_name]
+
+    if backend == 'numpy':
+        write_png(output, composite_highlight(highlight, extent, width, height, srs, style))
+        return
+
+    render_map(wms_query(mapfile, highlight['key'], extent, width, height, srs), mapfile,
+               '%s:%s' % (geo_file['boundary_file_name'], highlight_name), backend, output)
+
+# WMS GetMap of the raster's layers. The extent is in srs, which the map
+# template must list in its ows_srs metadata if it isn't 4326
+def map_query(mapfile, geo_file, raster, extent, width, height, srs='epsg:4326'):
+    layers = '%s_mask,%s,%s,%s_boundary' % (geo_file['boundary_file_name'],
+                                           raster['grid_layer_name'],
+                                           raster['stat_layer_name'],
+                                           geo_file['boundary_file_name'])
+    return wms_query(mapfile, layers, extent, width, height, srs)
+
+def wms_query(mapfile, layers, extent, width, height, srs='epsg:4326'):
+    bbox = ','.join(map(str, extent))
+    return ('TRANSPARENT=true&'
+            'SERVICE=WMS&'
+            'VERSION=1.1.1&'
+            'REQUEST=GetMap&'
+            'STYLES=&'
+            'FORMAT=image/png&'
+            'SRS=%s&'
+            'WIDTH=%s&'
+            'HEIGHT=%s&'
+            'MAP=%s&'
+            'LAYERS=%s&'
+            'BBOX=%s' % (srs,
+                         width,
+                         height,
+                         mapfile,
+                         layers,
+                         bbox))
+
+# label names the mapserv launch in the profile, such as boundary:field
+def render_map(query_string, mapfile, label, backend, output):
+    if backend == 'mapscript':
+        render_mapscript(mapfile, query_string, output)
+    else:
+        with profile_stage('mapserv:%s' % label, child=True):
+            render_cgi(query_string, output)
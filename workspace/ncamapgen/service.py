@@ -0,0 +1,96 @@
+##
+## Service
+## Keeps the map template, boundaries and worker pool (with its loaded
+## mapfiles) warm between jobs. A job is POSTed to /jobs as JSON:
+##   {"source": "input/P_RCP_26.csv", "fields": [...], "boundaries": [...], "force": false}
+## where fields (data column names) and boundaries (file names without
+## .shp) are optional. The job's renders and data rasters are streamed
+## back as a tar. Jobs are run one at a time
+##
+import json, os, traceback, tarfile
+try:
+    import SocketServer as socketserver
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    import socketserver
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from .render import render_outputs
+from .pipeline import Pipeline
+
+class JobHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        pipeline = self.server.pipeline
+        boundaries = {}
+        for (xres, yres), boundary_set in pipeline.boundary_sets.items():
+            boundaries['%s,%s' % (xres, yres)] = [boundary['boundary_file_name'] for boundary in boundary_set]
+        self.send_json(200, {
+            'fields': [field['data'] for field in pipeline.config['source']['fields']],
+            'boundaries': boundaries
+        })
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'Jobs are POSTed to /jobs'})
+            return
+
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            output_maps = self.server.pipeline.run([job['source']], job.get('force', False),
+                                                   job.get('fields'), job.get('boundaries'))
+        except (KeyError, ValueError) as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        except Exception:
+            self.send_json(500, {'error': traceback.format_exc()})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-tar')
+        self.end_headers()
+        archive = tarfile.open(fileobj=self.wfile, mode='w|')
+        for output_files_map in output_maps:
+            for geo_file in output_files_map['geo_files'].values():
+                for raster in geo_file['rasters']:
+                    paths = render_outputs(geo_file, raster) + [raster['grid_file']]
+                    for path in paths:
+                        if os.path.exists(path):
+                            archive.add(path)
+        archive.close()
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+# HTTP over a Unix socket, which has no client address to log
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ('local', 0)
+
+# address is [host:]port, or a path for a Unix socket
+def serve(config, address, jobs):
+    if address.isdigit() or ':' in address:
+        host, _, port = address.rpartition(':')
+        server = HTTPServer((host or 'localhost', int(port)), JobHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixHTTPServer(address, JobHandler)
+
+    # forked now, so the workers start with the template loaded
+    server.pipeline = Pipeline(config, jobs)
+    # warm the boundaries and point cache of the configured source
+    if os.path.exists(config['source']['path']):
+        server.pipeline.plan()
+
+    print('Serving jobs on %s' % address)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.pipeline.close()
@@ -0,0 +1,533 @@
+##
+## Tasks
+## The pipeline as a graph of tasks, and the executor that runs it on a
+## pool of worker processes, skipping whatever the build manifest shows
+## is already built from the same inputs
+##
+import json, os, hashlib, multiprocessing, traceback
+from osgeo import gdal
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from .profiling import start_profile, take_profile_records, profile_enabled, add_profile_records, profile_stage
+from .points import open_points, open_point_index, query_point_index, extract_boundary_points
+from .rasters import (generate_rasters, write_grids, interpolate_raster, classify_raster, hatch_stat, polygonize_stat,
+                      project_raster)
+from .render import render_style, build_mapfile, render_backend, render_outputs, render_image, render_highlight
+from .tiles import render_tiles
+
+# Runs every stage for one boundary in this process, so that rasters
+# kept in /vsimem/ can be handed from stage to stage without touching
+# the disk. The points are selected straight from the index rather
+# than written out
+def process_boundary(geo_file, points_dir, fields, xres, yres, source_nodata, cog_compress, interpolation,
+                     classes, stat_overlay, map_file, render_max, backend, tiles=None, render_srs='EPSG:4326',
+                     style=None):
+    with profile_stage('grid:' + geo_file['boundary_file_name']):
+        points = open_points(points_dir, fields)
+        ids = query_point_index(open_point_index(points_dir), points, geo_file['extent'])
+        write_grids(geo_file, points, ids, xres, yres, source_nodata, cog_compress)
+
+    for highlight in geo_file['highlight_files']:
+        with profile_stage('highlight:%s:%s' % (geo_file['boundary_file_name'], highlight['name'])):
+            render_highlight(map_file, geo_file, highlight['name'], render_max, backend, render_srs, style)
+
+    for raster in geo_file['rasters']:
+        raster_key = '%s:%s' % (geo_file['boundary_file_name'], raster['field'])
+        with profile_stage('interpolate:' + raster_key):
+            interpolate_raster(raster, geo_file['render_extent'], render_max, interpolation)
+        with profile_stage('classify:' + raster_key):
+            classify_raster(raster, classes)
+        if stat_overlay != 'raster':
+            with profile_stage('stat:' + raster_key):
+                polygonize_stat(raster)
+        elif prehatched_stat(stat_overlay, backend, render_srs):
+            with profile_stage('stat:' + raster_key):
+                hatch_stat(raster, geo_file['render_extent'], render_max)
+        if render_srs.upper() != 'EPSG:4326':
+            with profile_stage('project:' + raster_key):
+                project_raster(raster, geo_file['render_extent'], render_max, render_srs, stat_overlay)
+        with profile_stage('render:' + raster_key):
+            render_image(map_file, geo_file, raster, render_max, backend, stat_overlay, render_srs, style)
+        if tiles:
+            for zoom in range(tiles['zooms'][0], tiles['zooms'][1] + 1):
+                with profile_stage('tiles:%s:%d' % (raster_key, zoom)):
+                    render_tiles(map_file, geo_file, raster, tiles, zoom, backend, stat_overlay, style)
+
+        for path in (raster['stat_grid'], raster['interpolation_file'], raster['classified_file'], raster['stat_hatch'],
+                     raster.get('projected_file', ''), raster.get('projected_hatch', '')):
+            if path.startswith('/vsimem/'):
+                gdal.Unlink(path)
+
+# The pre-hatched stat raster is only drawn by MapServer in 4326. The
+# copies projected into another srs, and the compositor, hatch the stat
+# grid in their own pixels
+def prehatched_stat(stat_overlay, backend, render_srs):
+    return stat_overlay == 'raster' and backend != 'numpy' and render_srs.upper() == 'EPSG:4326'
+
+# The key is a hash of everything that goes into the task's outputs,
+# so the task can be skipped on a later run if none of it has changed
+def task(func, args, deps=(), outputs=(), inputs=None):
+    key = None
+    if inputs is not None:
+        key = hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    return {
+        'func': func,
+        'args': args,
+        'deps': list(deps),
+        'outputs': list(outputs),
+        'key': key,
+        # the build manifest the outputs are recorded in, if any
+        'manifest': None
+    }
+
+# This lays out the whole pipeline as a graph of tasks keyed by name.
+# Every boundary's points are extracted and gridded independently, and
+# each of its rasters is interpolated, overlaid and rendered as soon
+# as whatever it depends on is done. Each task's inputs include the keys
+# of the tasks it depends on, so changes carry through the graph. Task
+# names are prefixed with the output base, so the graphs of several
+# sources can be run together. The mapfile is built from mapfile_geo_files
+# if given, such as every boundary and field of a run limited to some
+def build_tasks(output_files_map, config, points_dir, template, mapfile_geo_files=None):
+    fields = config['source']['fields']
+    xres = config['source']['xres']
+    yres = config['source']['yres']
+    source_nodata = config['source'].get('nodata')
+    cog_compress = None
+    if config.get('output_profile', 'gtiff') == 'cog':
+        cog_compress = config.get('cog_compress', 'DEFLATE')
+    interpolation = config.get('interpolation', 'bilinear')
+    stat_overlay = config.get('stat_overlay', 'polygons')
+    render_srs = config.get('render_srs', 'EPSG:4326')
+    style = render_style(config)
+    tiles = config.get('tiles')
+    zooms = []
+    if tiles:
+        zooms = list(range(tiles['zooms'][0], tiles['zooms'][1] + 1))
+    map_file = output_files_map['map_file']
+    geo_files = list(output_files_map['geo_files'].values())
+    if mapfile_geo_files is None:
+        mapfile_geo_files = geo_files
+    manifest_file = output_files_map['manifest']
+    prefix = '%s/' % output_files_map['dirs']['base']
+    # the points cache is keyed by the CSV's hash and meridian correction
+    source_key = os.path.basename(points_dir)
+    template_key = template['key']
+
+    backend = render_backend(config)
+
+    boundary_keys = {}
+    highlight_keys = {}
+    for geo_file in mapfile_geo_files:
+        boundary_keys[geo_file['boundary_file_name']] = geo_file['boundary_hash']
+        highlight_keys[geo_file['boundary_file_name']] = dict(
+            (highlight['key'], highlight['hash']) for highlight in geo_file['highlight_files'])
+
+    mapfile_task = prefix + 'mapfile'
+    tasks = {
+        mapfile_task: task(build_mapfile,
+                           [mapfile_geo_files, template['text'], map_file, stat_overlay, style, render_srs],
+                           outputs=[map_file],
+                           inputs={
+                               'template': template_key,
+                               'boundaries': boundary_keys,
+                               # the cached copies drawn, per render size
+                               'boundary_files': dict((geo_file['boundary_file_name'],
+                                                       [geo_file['render_boundary_file'],
+                                                        geo_file['projected_boundary_file']])
+                                                      for geo_file in mapfile_geo_files),
+                               'highlights': highlight_keys,
+                               'fields': fields,
+                               'stat_overlay': stat_overlay,
+                               'style': style,
+                               'render_srs': render_srs,
+                               # which rasters the layers read from /vsimem/
+                               'in_memory': config.get('in_memory', False),
+                               'backend': backend
+                           })
+    }
+
+    for geo_file in geo_files:
+        boundary_name = geo_file['boundary_file_name']
+        if config.get('in_memory', False):
+            # one task per boundary, since /vsimem/ is per process
+            outputs = []
+            for raster in geo_file['rasters']:
+                outputs.append(raster['grid_file'])
+                outputs.extend(render_outputs(geo_file, raster))
+                if stat_overlay != 'raster':
+                    outputs.append(raster['stat_shp'])
+                outputs.extend(os.path.join(raster['tiles_dir'], str(zoom)) for zoom in zooms)
+            boundary_task = '%sboundary:%s' % (prefix, boundary_name)
+            tasks[boundary_task] = task(process_boundary,
+                                        [geo_file, points_dir, fields, xres, yres, source_nodata, cog_compress,
+                                         interpolation, template['classes'], stat_overlay, map_file,
+                                         config['render_max'], backend, tiles, render_srs, style],
+                                        [mapfile_task],
+                                        outputs=outputs,
+                                        inputs={
+                                            'source': source_key,
+                                            'boundary': boundary_keys[boundary_name],
+                                            'extent': geo_file['extent'],
+                                            'fields': fields,
+                                            'xres': xres,
+                                            'yres': yres,
+                                            'nodata': source_nodata,
+                                            'cog_compress': cog_compress,
+                                            'interpolation': interpolation,
+                                            'stat_overlay': stat_overlay,
+                                            'template': template_key,
+                                            'render_extent': geo_file['render_extent'],
+                                            'render_max': config['render_max'],
+                                            'render_srs': render_srs,
+                                            'style': style,
+                                            'highlights': highlight_keys[boundary_name],
+                                            'tiles': tiles,
+                                            'backend': backend
+                                        })
+            continue
+
+        points_task = '%spoints:%s' % (prefix, boundary_name)
+        grid_task = '%sgrid:%s' % (prefix, boundary_name)
+        tasks[points_task] = task(extract_boundary_points,
+                                  [geo_file, points_dir, fields],
+                                  outputs=[geo_file['points_ids_file']],
+                                  inputs={
+                                      'source': source_key,
+                                      'boundary': boundary_keys[boundary_name],
+                                      'extent': geo_file['extent'],
+                                      'fields': fields
+                                  })
+
+        grid_outputs = []
+        for raster in geo_file['rasters']:
+            grid_outputs.append(raster['grid_file'])
+            grid_outputs.append(raster['stat_grid'])
+        tasks[grid_task] = task(generate_rasters,
+                                [geo_file, points_dir, fields, xres, yres, source_nodata, cog_compress],
+                                [points_task],
+                                outputs=grid_outputs,
+                                inputs={
+                                    'points': tasks[points_task]['key'],
+                                    'xres': xres,
+                                    'yres': yres,
+                                    'nodata': source_nodata,
+                                    'cog_compress': cog_compress
+                                })
+
+        # each highlight's overlay is rendered once, and composited over
+        # the render of every field
+        highlight_tasks = []
+        for highlight in geo_file['highlight_files']:
+            highlight_task = '%shighlight:%s:%s' % (prefix, boundary_name, highlight['name'])
+            tasks[highlight_task] = task(render_highlight,
+                                         [map_file, geo_file, highlight['name'], config['render_max'], backend,
+                                          render_srs, style],
+                                         [mapfile_task],
+                                         outputs=[geo_file['highlight_overlay_files'][highlight['name']]],
+                                         inputs={
+                                             'template': template_key,
+                                             'highlight': highlight['hash'],
+                                             'render_extent': geo_file['render_extent'],
+                                             'render_max': config['render_max'],
+                                             'render_srs': render_srs,
+                                             'style': style,
+                                             'backend': backend
+                                         })
+            highlight_tasks.append(highlight_task)
+
+        for raster in geo_file['rasters']:
+            raster_key = '%s:%s' % (boundary_name, raster['field'])
+            interpolate_task = '%sinterpolate:%s' % (prefix, raster_key)
+            classify_task = '%sclassify:%s' % (prefix, raster_key)
+            stat_task = '%sstat:%s' % (prefix, raster_key)
+            tasks[interpolate_task] = task(interpolate_raster,
+                                           [raster, geo_file['render_extent'], config['render_max'], interpolation],
+                                           [grid_task],
+                                           outputs=[raster['interpolation_file']],
+                                           inputs={
+                                               'grid': tasks[grid_task]['key'],
+                                               'field': raster['field'],
+                                               'render_extent': geo_file['render_extent'],
+                                               'render_max': config['render_max'],
+                                               'interpolation': interpolation
+                                           })
+            tasks[classify_task] = task(classify_raster,
+                                        [raster, template['classes']],
+                                        [interpolate_task],
+                                        outputs=[raster['classified_file']],
+                                        inputs={
+                                            'interpolation': tasks[interpolate_task]['key'],
+                                            'classes': template['classes']
+                                        })
+            if stat_overlay == 'raster' and not prehatched_stat(stat_overlay, backend, render_srs):
+                # the stat grid is the layer, hatched as it is drawn
+                stat_task = grid_task
+            elif stat_overlay == 'raster':
+                tasks[stat_task] = task(hatch_stat,
+                                        [raster, geo_file['render_extent'], config['render_max']],
+                                        [grid_task],
+                                        outputs=[raster['stat_hatch']],
+                                        inputs={
+                                            'grid': tasks[grid_task]['key'],
+                                            'stat_field': raster['stat_field'],
+                                            'render_extent': geo_file['render_extent'],
+                                            'render_max': config['render_max']
+                                        })
+            else:
+                tasks[stat_task] = task(polygonize_stat,
+                                        [raster],
+                                        [grid_task],
+                                        outputs=[raster['stat_shp']],
+                                        inputs={
+                                            'grid': tasks[grid_task]['key'],
+                                            'stat_field': raster['stat_field']
+                                        })
+            # the layers are drawn from, projected into the render srs once
+            # for every image and tile drawn from them
+            layer_tasks = [classify_task, stat_task]
+            if render_srs.upper() != 'EPSG:4326':
+                project_task = '%sproject:%s' % (prefix, raster_key)
+                tasks[project_task] = task(project_raster,
+                                           [raster, geo_file['render_extent'], config['render_max'], render_srs,
+                                            stat_overlay],
+                                           [classify_task, stat_task],
+                                           outputs=[raster['projected_file'],
+                                                    raster['projected_hatch'] if stat_overlay == 'raster'
+                                                    else raster['projected_stat_shp']],
+                                           inputs={
+                                               'classified': tasks[classify_task]['key'],
+                                               'stat': tasks[stat_task]['key'],
+                                               'render_extent': geo_file['render_extent'],
+                                               'render_max': config['render_max'],
+                                               'render_srs': render_srs
+                                           })
+                layer_tasks = [project_task]
+
+            # only this raster's inputs, not the whole mapfile, so adding
+            # a boundary doesn't re-render every other boundary
+            render_task = '%srender:%s' % (prefix, raster_key)
+            tasks[render_task] = task(render_image,
+                                      [map_file, geo_file, raster, config['render_max'], backend, stat_overlay,
+                                       render_srs, style],
+                                      [mapfile_task] + layer_tasks + highlight_tasks,
+                                      outputs=render_outputs(geo_file, raster),
+                                      inputs={
+                                          'template': template_key,
+                                          'boundary': boundary_keys[boundary_name],
+                                          'highlights': [tasks[name]['key'] for name in highlight_tasks],
+                                          'layers': [tasks[name]['key'] for name in layer_tasks],
+                                          'render_extent': geo_file['render_extent'],
+                                          'render_max': config['render_max'],
+                                          'render_srs': render_srs,
+                                          'style': style,
+                                          'backend': backend
+                                      })
+            # a task per zoom level, as the deeper ones hold most tiles
+            for zoom in zooms:
+                tiles_task = '%stiles:%s:%d' % (prefix, raster_key, zoom)
+                tasks[tiles_task] = task(render_tiles,
+                                         [map_file, geo_file, raster, tiles, zoom, backend, stat_overlay, style],
+                                         [mapfile_task] + layer_tasks,
+                                         outputs=[os.path.join(raster['tiles_dir'], str(zoom))],
+                                         inputs={
+                                             'template': template_key,
+                                             'boundary': boundary_keys[boundary_name],
+                                             'layers': [tasks[name]['key'] for name in layer_tasks],
+                                             'render_extent': geo_file['render_extent'],
+                                             'tiles': tiles,
+                                             'style': style,
+                                             'backend': backend,
+                                             'zoom': zoom
+                                         })
+
+    for current in tasks.values():
+        current['manifest'] = manifest_file
+
+    return tasks
+
+## The build manifest records, for every output, the key of the task
+## that last produced it
+def load_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as file_in:
+        return json.load(file_in)
+
+def save_manifest(manifest, manifest_file):
+    part_file = '%s.part' % manifest_file
+    with open(part_file, 'wt') as file_out:
+        json.dump(manifest, file_out, indent=2, sort_keys=True)
+    os.rename(part_file, manifest_file)
+
+def up_to_date(manifest, current):
+    if current['key'] is None or not current['outputs']:
+        return False
+    for output in current['outputs']:
+        if manifest.get(output) != current['key'] or not os.path.exists(output):
+            return False
+    return True
+
+def record_outputs(manifest, current):
+    if current['key'] is not None:
+        for output in current['outputs']:
+            manifest[output] = current['key']
+
+# runs in the worker, reporting failures back as text since not every
+# exception can be pickled, along with any profile records taken
+def call_task(name, func, args, profile=False):
+    # forked workers start with a copy of the main process' records
+    if profile:
+        start_profile()
+    try:
+        with profile_stage(name):
+            func(*args)
+        return name, None, take_profile_records()
+    except Exception:
+        return name, traceback.format_exc(), take_profile_records()
+
+# raised when a worker process dies mid-task, killed for its memory or
+# crashed inside GDAL or MapServer, as its task will never finish
+class WorkerLostError(RuntimeError):
+    pass
+
+# how long to wait on the running tasks before checking on the workers
+POLL_SECONDS = 2
+
+# Waits for the next running task to finish, returning its name, error and
+# profile records. A task whose arguments or result can't be pickled fails
+# without calling back, and a task whose worker dies never finishes, as the
+# pool just replaces the worker, so the results and the workers (every one
+# seen, in workers) are checked whenever nothing has finished for a while
+def wait_task(finished, pool, workers, running):
+    while True:
+        try:
+            name, error, records = finished.get(timeout=POLL_SECONDS)
+            running.pop(name)
+            return name, error, records
+        except queue.Empty:
+            pass
+
+        for name, result in sorted(running.items()):
+            if result.ready() and not result.successful():
+                running.pop(name)
+                try:
+                    result.get()
+                except Exception:
+                    return name, traceback.format_exc(), []
+
+        workers.extend(worker for worker in list(pool._pool) if worker not in workers)
+        dead = [worker for worker in workers if worker.exitcode is not None]
+        if dead:
+            raise WorkerLostError('A worker process exited with code %s while running %s' % (
+                dead[0].exitcode, ', '.join(sorted(running))))
+
+def ready_tasks(pending, done):
+    return sorted(name for name, pending_task in pending.items() if done.issuperset(pending_task['deps']))
+
+# marks the ready tasks whose outputs are current as done, repeating since
+# skipping one task can make others ready
+def skip_up_to_date(pending, done, manifests):
+    skipped = True
+    while skipped:
+        skipped = False
+        for name in ready_tasks(pending, done):
+            if up_to_date(manifests.get(pending[name]['manifest'], {}), pending[name]):
+                pending.pop(name)
+                done.add(name)
+                skipped = True
+
+# the failed tasks' errors, and how many tasks were left out for
+# depending on them, as one error
+def failed_tasks_error(failures, blocked):
+    message = '\n'.join('Task %s failed:\n%s' % (name, failures[name]) for name in sorted(failures))
+    if blocked:
+        message += '\n%d tasks depending on them were not run: %s' % (len(blocked), ', '.join(sorted(blocked)))
+    return RuntimeError(message)
+
+# Runs the task graph, submitting each task to a pool of worker processes
+# as soon as all of its dependencies have finished. With a single job the
+# tasks run in this process instead. Tasks whose outputs were already
+# built from the same inputs, per their manifest, are skipped. A failed
+# task only stops the tasks depending on it: everything else is still
+# run, such as the other boundaries and sources of a batch, and the
+# failures are raised together at the end. When this process is
+# profiling, so are the workers. A pool that outlives the run, such as
+# the service's, can be passed in; after a WorkerLostError it may still be
+# running some of the run's tasks, and should be replaced
+def run_tasks(tasks, jobs, pool=None):
+    pending = dict(tasks)
+    done = set()
+    failures = {}
+    manifests = {}
+    for current in tasks.values():
+        if current['manifest'] and current['manifest'] not in manifests:
+            manifests[current['manifest']] = load_manifest(current['manifest'])
+
+    def finish(name):
+        done.add(name)
+        manifest_file = tasks[name]['manifest']
+        if manifest_file:
+            record_outputs(manifests[manifest_file], tasks[name])
+            save_manifest(manifests[manifest_file], manifest_file)
+
+    if jobs <= 1:
+        while pending:
+            skip_up_to_date(pending, done, manifests)
+            if not pending:
+                break
+            ready = ready_tasks(pending, done)
+            if not ready:
+                break
+            for name in ready:
+                current = pending.pop(name)
+                try:
+                    with profile_stage(name):
+                        current['func'](*current['args'])
+                except Exception:
+                    failures[name] = traceback.format_exc()
+                    continue
+                finish(name)
+    else:
+        run_pool(tasks, jobs, pool, pending, done, failures, manifests, finish)
+
+    if failures:
+        raise failed_tasks_error(failures, pending)
+    if pending:
+        raise ValueError('Unresolvable task dependencies: %s' % ', '.join(sorted(pending)))
+
+# the pool side of run_tasks
+def run_pool(tasks, jobs, pool, pending, done, failures, manifests, finish):
+    finished = queue.Queue()
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(jobs)
+    # the result of each submitted task, by name, until it finishes
+    running = {}
+    workers = list(pool._pool)
+    try:
+        while pending or running:
+            skip_up_to_date(pending, done, manifests)
+            for name in ready_tasks(pending, done):
+                current = pending.pop(name)
+                running[name] = pool.apply_async(call_task,
+                                                 (name, current['func'], current['args'], profile_enabled()),
+                                                 callback=finished.put)
+            # the rest, if any, wait on a failed task or can't be resolved
+            if not running:
+                break
+
+            name, error, records = wait_task(finished, pool, workers, running)
+            add_profile_records(records)
+            if error:
+                failures[name] = error
+            else:
+                finish(name)
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
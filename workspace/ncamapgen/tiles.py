@@ -0,0 +1,120 @@
+##
+## Tiles
+## Each boundary/field is also rendered as a z/x/y pyramid of 256 pixel
+## PNG tiles in a projected srs. Blocks of metatile by metatile tiles are
+## drawn as one image and sliced, so that the layers are drawn once per
+## block rather than once per tile
+##
+import os, math, shutil
+import numpy
+
+from .common import mkdir, transform_extent, ogr_driver
+from .rasters import HATCH_COLORS
+from .render import (write_png, read_image, alpha_composite, composite, stat_pixels, rasterize_onto, map_query,
+                     wms_query, render_map)
+
+TILE_SIZE = 256
+
+# the top left corner and width of zoom level 0 of each tile matrix. 3857
+# is the usual web mercator one; the 5070 one covers CONUS, Alaska and
+# Hawaii in Albers
+TILE_GRIDS = {
+    'EPSG:3857': {'origin': (-20037508.342789244, 20037508.342789244), 'size': 40075016.68557849},
+    'EPSG:5070': {'origin': (-8000000.0, 8000000.0), 'size': 16000000.0}
+}
+
+def tile_extent(grid, zoom, x, y, count=1):
+    size = grid['size'] / 2 ** zoom
+    left = grid['origin'][0] + x * size
+    top = grid['origin'][1] - y * size
+    return [left, top - count * size, left + count * size, top]
+
+# the first and last column and row of the tiles covering the extent
+def tile_range(grid, zoom, extent):
+    size = grid['size'] / 2 ** zoom
+    last = 2 ** zoom - 1
+    def clamp(value):
+        return min(max(int(math.floor(value)), 0), last)
+    return (clamp((extent[0] - grid['origin'][0]) / size),
+            clamp((grid['origin'][1] - extent[3]) / size),
+            clamp((extent[2] - grid['origin'][0]) / size),
+            clamp((grid['origin'][1] - extent[1]) / size))
+
+# Tiles of a single color, such as the blank ones outside the boundary,
+# are all hard links to one PNG per color in shared_dir
+def save_tile(path, tile, shared_dir):
+    mkdir(os.path.dirname(path))
+    if os.path.exists(path):
+        os.remove(path)
+
+    if not (tile == tile[0, 0]).all():
+        write_png(path, tile)
+        return
+
+    shared = os.path.join(shared_dir, '%02x%02x%02x%02x.png' % tuple(tile[0, 0]))
+    if not os.path.exists(shared):
+        mkdir(shared_dir)
+        write_png('%s.%d.part' % (shared, os.getpid()), tile)
+        os.rename('%s.%d.part' % (shared, os.getpid()), shared)
+    try:
+        os.link(shared, path)
+    except OSError:
+        shutil.copyfile(shared, path)
+
+# Renders a block through MapServer. The raster significance overlay is
+# hatched at the boundary's render size, so for tiles it is left out of
+# the map and hatched in the block's own pixels instead, anchored to the
+# tile matrix as in the compositor, with the boundary outline drawn over it
+def render_block(mapfile, geo_file, raster, extent, size, srs, backend, stat_overlay, origin):
+    block_file = os.path.join(raster['tiles_dir'], 'block.%d.png' % os.getpid())
+    label = '%s:%s' % (geo_file['boundary_file_name'], raster['field'])
+    if stat_overlay != 'raster':
+        render_map(map_query(mapfile, geo_file, raster, extent, size, size, srs), mapfile, label, backend, block_file)
+        image = read_image(block_file)
+    else:
+        boundary_name = geo_file['boundary_file_name']
+        render_map(wms_query(mapfile, '%s_mask,%s' % (boundary_name, raster['grid_layer_name']), extent, size, size,
+                             srs),
+                   mapfile, label, backend, block_file)
+        image = read_image(block_file)
+
+        boundary_source = ogr_driver('ESRI Shapefile').Open(geo_file['render_boundary_file'], 0)
+        mask = rasterize_onto(boundary_source.GetLayer(), extent, size, size, srs=srs).astype(bool)
+        overlay = stat_pixels(raster, extent, size, size, stat_overlay, srs, origin)
+        overlay[~mask] = 0
+        image = alpha_composite(image, numpy.array(HATCH_COLORS, dtype=numpy.uint8)[overlay])
+
+        render_map(wms_query(mapfile, '%s_boundary' % boundary_name, extent, size, size, srs), mapfile, label,
+                   backend, block_file)
+        image = alpha_composite(image, read_image(block_file))
+    os.remove(block_file)
+    return image
+
+# Renders the raster's tiles at one zoom level, a metatile block at a time
+def render_tiles(mapfile, geo_file, raster, tiles, zoom, backend, stat_overlay, style=None):
+    srs = tiles['srs'].upper()
+    grid = TILE_GRIDS[srs]
+    metatile = tiles.get('metatile', 8)
+    first_x, first_y, last_x, last_y = tile_range(grid, zoom, transform_extent(geo_file['render_extent'], srs))
+    # blocks are aligned to multiples of metatile, but not past the edge
+    count = min(metatile, 2 ** zoom)
+    mkdir(raster['tiles_dir'])
+
+    for block_y in range(first_y - first_y % count, last_y + 1, count):
+        for block_x in range(first_x - first_x % count, last_x + 1, count):
+            extent = tile_extent(grid, zoom, block_x, block_y, count)
+            size = count * TILE_SIZE
+            if backend == 'numpy':
+                image = composite(geo_file, raster, extent, size, size, stat_overlay, srs,
+                                  origin=(block_y * TILE_SIZE, block_x * TILE_SIZE), style=style)
+            else:
+                image = render_block(mapfile, geo_file, raster, extent, size, srs, backend, stat_overlay,
+                                     (block_y * TILE_SIZE, block_x * TILE_SIZE))
+
+            for y in range(max(block_y, first_y), min(block_y + count, last_y + 1)):
+                for x in range(max(block_x, first_x), min(block_x + count, last_x + 1)):
+                    row = (y - block_y) * TILE_SIZE
+                    col = (x - block_x) * TILE_SIZE
+                    save_tile(os.path.join(raster['tiles_dir'], str(zoom), str(x), '%d.png' % y),
+                              image[row:row + TILE_SIZE, col:col + TILE_SIZE],
+                              os.path.join(os.path.dirname(raster['tiles_dir']), 'shared'))
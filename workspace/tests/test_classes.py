@@ -0,0 +1,51 @@
+import os, shutil, tempfile, unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.rasters import parse_classes, classify_pixels
+
+CLASSES_FILE = os.path.join(os.path.dirname(__file__), '..', 'input', 'mapdata', 'classes.cmap')
+
+class ClassesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_classes(self, text):
+        path = os.path.join(self.temp_dir, 'classes.cmap')
+        with open(path, 'wt') as file_out:
+            file_out.write(text)
+        return path
+
+    def test_class_boundaries_match_mapserver(self):
+        classes = parse_classes(CLASSES_FILE)
+        self.assertEqual(classes[0]['conditions'], [('<', -20.0)])
+        self.assertEqual(classes[1]['conditions'], [('>=', -20.0), ('<', -15.0)])
+
+        values = numpy.array([-20.001, -20.0, -15.001, -15.0, 15.0, 99.0, 3.0])
+        valid = numpy.array([True, True, True, True, True, True, False])
+        self.assertEqual(classify_pixels(values, valid, classes).tolist(), [1, 2, 2, 3, 9, 9, 0])
+
+    def test_first_matching_class_wins(self):
+        classes = [{'conditions': [('<', 5.0)], 'color': (1, 1, 1)},
+                   {'conditions': [], 'color': (2, 2, 2)}]
+        values = numpy.array([4.0, 5.0])
+        self.assertEqual(classify_pixels(values, numpy.ones(2, dtype=bool), classes).tolist(), [1, 2])
+
+    def test_unsupported_expressions_are_rejected(self):
+        for expression in ('([pixel] < 1 OR [pixel] > 3)', '("[pixel]" eq "a")', '/^a/', '(5 < [pixel])'):
+            path = self.write_classes('CLASS\n  EXPRESSION %s\n  STYLE\n    COLOR 1 2 3\n  END\nEND\n' % expression)
+            self.assertRaises(ValueError, parse_classes, path)
+
+    def test_class_without_color_is_rejected(self):
+        path = self.write_classes('CLASS\n  NAME "cold"\n  EXPRESSION ([pixel] < 0)\nEND\n')
+        self.assertRaises(ValueError, parse_classes, path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.render import alpha_composite
+
+def pixel(*rgba):
+    return numpy.array(rgba, dtype=numpy.uint8).reshape(1, 1, 4)
+
+class AlphaCompositeTest(unittest.TestCase):
+    def test_opaque_overlay_replaces_the_base(self):
+        self.assertEqual(alpha_composite(pixel(10, 20, 30, 255), pixel(0, 0, 0, 255)).tolist(), [[[0, 0, 0, 255]]])
+
+    def test_transparent_overlay_keeps_the_base(self):
+        for base in (pixel(10, 20, 30, 255), pixel(200, 0, 0, 128), pixel(0, 0, 0, 0)):
+            self.assertEqual(alpha_composite(base, pixel(0, 0, 0, 0)).tolist(), base.tolist())
+
+    def test_overlay_over_a_transparent_base(self):
+        self.assertEqual(alpha_composite(pixel(0, 0, 0, 0), pixel(40, 50, 60, 128)).tolist(), [[[40, 50, 60, 128]]])
+
+    def test_half_transparent_overlay_blends(self):
+        blended = alpha_composite(pixel(255, 255, 255, 255), pixel(0, 0, 0, 128))
+        self.assertEqual(blended[0, 0, 3], 255)
+        self.assertTrue(abs(int(blended[0, 0, 0]) - 127) <= 1)
+
+if __name__ == '__main__':
+    unittest.main()
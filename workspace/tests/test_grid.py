@@ -0,0 +1,39 @@
+import os, unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.points import grid_step, detect_grid
+
+INPUT_DIR = os.path.join(os.path.dirname(__file__), '..', 'input')
+
+class GridStepTest(unittest.TestCase):
+    def test_regular_steps(self):
+        index = numpy.arange(1, 129)
+        self.assertEqual(grid_step(index, (index - 1) * 2.8125, 360), 2.8125)
+        self.assertEqual(grid_step(index, 89.25 - (index - 1) * 1.5), 1.5)
+
+    def test_longitudes_wrap_across_the_meridian(self):
+        index = numpy.arange(1, 241)
+        lon = (180 + (index - 1) * 1.5) % 360 - 180
+        self.assertEqual(grid_step(index, lon, 360), 1.5)
+
+    def test_missing_rows_and_repeated_indices(self):
+        index = numpy.repeat(numpy.array([1, 2, 3, 5, 8, 9]), 3)
+        self.assertEqual(grid_step(index, index * 0.5), 0.5)
+
+    def test_irregular_or_single_index_is_none(self):
+        index = numpy.arange(1, 101)
+        self.assertIsNone(grid_step(index, numpy.random.RandomState(0).uniform(0, 100, 100)))
+        self.assertIsNone(grid_step(numpy.ones(10), numpy.arange(10.0)))
+
+class DetectGridTest(unittest.TestCase):
+    def test_sample_sources(self):
+        self.assertEqual(detect_grid(os.path.join(INPUT_DIR, 'P_RCP_26.csv')), {'xres': 1.5, 'yres': 1.5})
+        self.assertEqual(detect_grid(os.path.join(INPUT_DIR, 'A2-t2m-ave.csv')), {'xres': 2.8125, 'yres': 2.79})
+
+if __name__ == '__main__':
+    unittest.main()
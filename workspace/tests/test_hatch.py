@@ -0,0 +1,30 @@
+import unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.rasters import hatch_pixels
+
+class HatchPixelsTest(unittest.TestCase):
+    def test_lines_are_spaced_as_the_hatch_symbol(self):
+        hatch = hatch_pixels(numpy.full((100, 100), 3), spacing=25)
+        # 25 pixels apart across the 45 degree lines
+        self.assertEqual(numpy.flatnonzero(hatch[0]).tolist(), [0, 35, 70])
+
+    def test_fill_and_no_significance(self):
+        sig = numpy.array([[0, 1, 2]])
+        self.assertEqual(hatch_pixels(sig).tolist(), [[0, 0, 2]])
+
+    def test_pieces_line_up_with_the_whole(self):
+        sig = numpy.full((64, 64), 3)
+        whole = hatch_pixels(sig, 10)
+        for row in (0, 32):
+            for col in (0, 32):
+                piece = hatch_pixels(sig[row:row + 32, col:col + 32], 10, origin=(row, col))
+                numpy.testing.assert_array_equal(piece, whole[row:row + 32, col:col + 32])
+
+if __name__ == '__main__':
+    unittest.main()
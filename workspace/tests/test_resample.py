@@ -0,0 +1,48 @@
+import unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.rasters import resample_grid
+
+class ResampleGridTest(unittest.TestCase):
+    def test_constant_field_with_hole_stays_constant(self):
+        grid = numpy.full((4, 4), 5.0)
+        valid = numpy.ones(grid.shape, dtype=bool)
+        # the hole's value must not bleed into its neighbours
+        grid[1, 2] = 1e6
+        valid[1, 2] = False
+
+        for method in ('bilinear', 'bicubic'):
+            result, result_valid = resample_grid(grid, valid, 10, 10, method)
+            self.assertTrue(result_valid.all())
+            numpy.testing.assert_allclose(result, 5.0)
+
+    def test_linear_ramp_is_reproduced(self):
+        rows, cols = numpy.mgrid[0:6, 0:6].astype(float)
+        grid = 2 * cols + 3 * rows
+        valid = numpy.ones(grid.shape, dtype=bool)
+        # the output pixel centers in source pixels, as resample_grid places them
+        positions = (numpy.arange(12) + 0.5) * 6 / 12.0 - 0.5
+        expected = 2 * positions[None, :] + 3 * positions[:, None]
+
+        # taps past the edge are clamped, so only compare where none are
+        for method, first, last in (('bilinear', 0, 5), ('bicubic', 1, 4)):
+            result, result_valid = resample_grid(grid, valid, 12, 12, method)
+            inside = (positions >= first) & (positions <= last)
+            self.assertTrue(result_valid.all())
+            numpy.testing.assert_allclose(result[numpy.ix_(inside, inside)], expected[numpy.ix_(inside, inside)])
+
+    def test_pixels_without_valid_taps_are_invalid(self):
+        grid = numpy.zeros((4, 4))
+        valid = numpy.zeros(grid.shape, dtype=bool)
+        valid[0, 0] = True
+        _, result_valid = resample_grid(grid, valid, 8, 8, 'bilinear')
+        self.assertTrue(result_valid[0, 0])
+        self.assertFalse(result_valid[7, 7])
+
+if __name__ == '__main__':
+    unittest.main()
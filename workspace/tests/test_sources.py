@@ -0,0 +1,39 @@
+import os, shutil, tempfile, unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.pipeline import expand_sources
+
+class ExpandSourcesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        for name in ('b_rcp85.csv', 'a_rcp85.csv', 'a_rcp26.csv', 'notes.txt'):
+            open(self.path(name), 'wt').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def path(self, name):
+        return os.path.join(self.temp_dir, name)
+
+    def test_patterns_expand_in_sorted_order(self):
+        self.assertEqual(expand_sources([self.path('*.csv')]),
+                         [self.path('a_rcp26.csv'), self.path('a_rcp85.csv'), self.path('b_rcp85.csv')])
+
+    def test_patterns_keep_their_order_without_repeats(self):
+        self.assertEqual(expand_sources([self.path('b_*.csv'), self.path('*_rcp85.csv'), self.path('a_rcp85.csv')]),
+                         [self.path('b_rcp85.csv'), self.path('a_rcp85.csv')])
+
+    def test_plain_paths_are_kept(self):
+        # plain paths are passed through as given, even missing ones
+        self.assertEqual(expand_sources([self.path('missing.csv')]), [self.path('missing.csv')])
+
+    def test_pattern_without_matches_is_an_error(self):
+        self.assertRaises(ValueError, expand_sources, [self.path('*.csv'), self.path('*.tsv')])
+
+if __name__ == '__main__':
+    unittest.main()
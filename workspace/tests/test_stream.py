@@ -0,0 +1,49 @@
+import os, shutil, tempfile, unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.points import point_columns, parse_points, cache_points, open_points, within_extents
+
+SOURCE_FILE = os.path.join(os.path.dirname(__file__), '..', 'input', 'P_RCP_26.csv')
+FIELDS = [{'data': 'P2041_2070', 'stat': 'Stat_Sig_70'}, {'data': 'P2070_2099', 'stat': 'Stat_Sig_99'}]
+# CONUS and Alaska
+EXTENTS = [[-125.0, 24.0, -66.0, 50.0], [-170.0, 51.0, -129.0, 72.0]]
+
+class StreamPointsTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_streamed_cache_is_the_parse_within_the_extents(self):
+        parsed = parse_points(SOURCE_FILE, FIELDS, True)
+        keep = within_extents(parsed['LON'], parsed['LAT'], EXTENTS)
+        self.assertTrue(0 < keep.sum() < len(keep))
+
+        # a chunk size that doesn't divide the rows, so the last chunk is short
+        points_dir = cache_points(SOURCE_FILE, FIELDS, True, self.cache_dir, chunk_rows=1000, extents=EXTENTS)
+        streamed = open_points(points_dir, FIELDS)
+        for column in point_columns(FIELDS):
+            self.assertEqual(streamed[column].dtype, parsed[column].dtype)
+            numpy.testing.assert_array_equal(streamed[column], parsed[column][keep])
+
+    def test_nothing_within_the_extents(self):
+        points_dir = cache_points(SOURCE_FILE, FIELDS, True, self.cache_dir, chunk_rows=1000,
+                                  extents=[[0.0, 89.9, 0.1, 90.0]])
+        streamed = open_points(points_dir, FIELDS)
+        for column in point_columns(FIELDS):
+            self.assertEqual(len(streamed[column]), 0)
+
+    def test_streamed_cache_is_keyed_by_the_extents(self):
+        whole_dir = cache_points(SOURCE_FILE, FIELDS, True, self.cache_dir)
+        streamed_dir = cache_points(SOURCE_FILE, FIELDS, True, self.cache_dir, chunk_rows=1000, extents=EXTENTS)
+        other_dir = cache_points(SOURCE_FILE, FIELDS, True, self.cache_dir, chunk_rows=1000, extents=EXTENTS[:1])
+        self.assertEqual(len(set([whole_dir, streamed_dir, other_dir])), 3)
+
+if __name__ == '__main__':
+    unittest.main()
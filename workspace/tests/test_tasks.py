@@ -0,0 +1,153 @@
+import os, shutil, tempfile, unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.tasks import task, ready_tasks, run_tasks, up_to_date, skip_up_to_date, load_manifest
+
+# appends the name to the log file, so the order the tasks ran in can be
+# checked, even when they ran in worker processes
+def log_task(log_file, name):
+    with open(log_file, 'at') as file_out:
+        file_out.write(name + '\n')
+
+def fail_task(message):
+    raise ValueError(message)
+
+def write_output(log_file, output_file, text):
+    log_task(log_file, os.path.basename(output_file))
+    with open(output_file, 'wt') as file_out:
+        file_out.write(text)
+
+class TaskGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.temp_dir, 'log.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def log_task(self, name, deps=()):
+        return task(log_task, (self.log_file, name), deps)
+
+    def logged(self):
+        if not os.path.exists(self.log_file):
+            return []
+        with open(self.log_file) as file_in:
+            return file_in.read().split()
+
+    def test_ready_tasks(self):
+        pending = {'c': self.log_task('c', ['a', 'b']), 'b': self.log_task('b', ['a']), 'a': self.log_task('a')}
+        self.assertEqual(ready_tasks(pending, set()), ['a'])
+        self.assertEqual(ready_tasks(pending, set(['a'])), ['a', 'b'])
+        self.assertEqual(ready_tasks(pending, set(['a', 'b'])), ['a', 'b', 'c'])
+
+    def test_tasks_run_after_their_deps(self):
+        for jobs in (1, 2):
+            tasks = {'grid': self.log_task('grid', ['points']),
+                     'render': self.log_task('render', ['grid', 'style']),
+                     'points': self.log_task('points'),
+                     'style': self.log_task('style')}
+            run_tasks(tasks, jobs)
+            logged = self.logged()
+            self.assertEqual(sorted(logged), sorted(tasks))
+            for name, current in tasks.items():
+                for dep in current['deps']:
+                    self.assertLess(logged.index(dep), logged.index(name))
+            os.remove(self.log_file)
+
+    def test_failure_only_stops_its_dependents(self):
+        for jobs in (1, 2):
+            tasks = {'bad': task(fail_task, ('no points',)),
+                     'after_bad': self.log_task('after_bad', ['bad']),
+                     'good': self.log_task('good'),
+                     'after_good': self.log_task('after_good', ['good'])}
+            with self.assertRaises(RuntimeError) as raised:
+                run_tasks(tasks, jobs)
+            self.assertEqual(sorted(self.logged()), ['after_good', 'good'])
+            self.assertIn('Task bad failed', str(raised.exception))
+            self.assertIn('no points', str(raised.exception))
+            self.assertIn('1 tasks depending on them were not run: after_bad', str(raised.exception))
+            os.remove(self.log_file)
+
+    def test_unresolvable_deps(self):
+        tasks = {'a': self.log_task('a', ['missing'])}
+        self.assertRaises(ValueError, run_tasks, tasks, 1)
+        self.assertRaises(ValueError, run_tasks, tasks, 2)
+        self.assertEqual(self.logged(), [])
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.temp_dir, 'log.txt')
+        self.manifest_file = os.path.join(self.temp_dir, 'manifest.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def output(self, name):
+        return os.path.join(self.temp_dir, name)
+
+    def write_task(self, name, text, deps=()):
+        current = task(write_output, (self.log_file, self.output(name), text), deps,
+                       outputs=[self.output(name)], inputs={'text': text})
+        current['manifest'] = self.manifest_file
+        return current
+
+    def logged(self):
+        if not os.path.exists(self.log_file):
+            return []
+        with open(self.log_file) as file_in:
+            return file_in.read().split()
+
+    def test_up_to_date(self):
+        current = self.write_task('a.txt', 'a')
+        manifest = {self.output('a.txt'): current['key']}
+        # recorded, but not built yet
+        self.assertFalse(up_to_date(manifest, current))
+
+        write_output(self.log_file, self.output('a.txt'), 'a')
+        self.assertTrue(up_to_date(manifest, current))
+        self.assertFalse(up_to_date({}, current))
+        self.assertFalse(up_to_date(manifest, self.write_task('a.txt', 'changed')))
+
+        # tasks without inputs or outputs are never skipped
+        self.assertFalse(up_to_date(manifest, task(write_output, (), outputs=[self.output('a.txt')])))
+        self.assertFalse(up_to_date(manifest, dict(current, outputs=[])))
+
+    def test_skip_up_to_date_follows_the_graph(self):
+        tasks = {'a': self.write_task('a.txt', 'a'),
+                 'b': self.write_task('b.txt', 'b', ['a']),
+                 'c': self.write_task('c.txt', 'c', ['b'])}
+        for name in ('a', 'b'):
+            write_output(self.log_file, self.output('%s.txt' % name), name)
+        manifests = {self.manifest_file: {self.output('a.txt'): tasks['a']['key'],
+                                          self.output('b.txt'): tasks['b']['key']}}
+
+        pending = dict(tasks)
+        done = set()
+        skip_up_to_date(pending, done, manifests)
+        self.assertEqual(done, set(['a', 'b']))
+        self.assertEqual(sorted(pending), ['c'])
+
+    def test_reruns_only_changed_tasks(self):
+        run_tasks({'a': self.write_task('a.txt', 'a'), 'b': self.write_task('b.txt', 'b', ['a'])}, 1)
+        self.assertEqual(self.logged(), ['a.txt', 'b.txt'])
+        self.assertEqual(sorted(load_manifest(self.manifest_file)), [self.output('a.txt'), self.output('b.txt')])
+
+        run_tasks({'a': self.write_task('a.txt', 'a'), 'b': self.write_task('b.txt', 'b', ['a'])}, 1)
+        self.assertEqual(self.logged(), ['a.txt', 'b.txt'])
+
+        run_tasks({'a': self.write_task('a.txt', 'a'), 'b': self.write_task('b.txt', 'changed', ['a'])}, 2)
+        self.assertEqual(self.logged(), ['a.txt', 'b.txt', 'b.txt'])
+
+        # a deleted output is rebuilt even though the manifest has it
+        os.remove(self.output('a.txt'))
+        run_tasks({'a': self.write_task('a.txt', 'a')}, 1)
+        self.assertEqual(self.logged(), ['a.txt', 'b.txt', 'b.txt', 'a.txt'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+try:
+    import numpy
+    import osgeo
+except ImportError:
+    raise unittest.SkipTest('numpy and the GDAL python bindings are not installed')
+
+from ncamapgen.tiles import TILE_GRIDS, tile_extent, tile_range
+
+GRID = TILE_GRIDS['EPSG:5070']
+
+class TileExtentTest(unittest.TestCase):
+    def test_zoom_zero_covers_the_grid(self):
+        for grid in TILE_GRIDS.values():
+            origin, size = grid['origin'], grid['size']
+            numpy.testing.assert_allclose(tile_extent(grid, 0, 0, 0),
+                                          [origin[0], origin[1] - size, origin[0] + size, origin[1]])
+
+    def test_rows_count_down_from_the_top(self):
+        self.assertEqual(tile_extent(GRID, 1, 1, 0), [0.0, 0.0, 8000000.0, 8000000.0])
+        self.assertEqual(tile_extent(GRID, 1, 0, 1), [-8000000.0, -8000000.0, 0.0, 0.0])
+
+    def test_metatile_spans_count_tiles(self):
+        self.assertEqual(tile_extent(GRID, 2, 1, 2, count=2), [-4000000.0, -8000000.0, 4000000.0, 0.0])
+
+class TileRangeTest(unittest.TestCase):
+    def test_range_covers_the_extent(self):
+        self.assertEqual(tile_range(GRID, 2, [-3999999.0, -1.0, 3999999.0, 1.0]), (1, 1, 2, 2))
+
+    def test_tile_extent_round_trips(self):
+        for x, y in ((0, 0), (3, 1), (5, 7)):
+            left, bottom, right, top = tile_extent(GRID, 3, x, y)
+            inside = [left + 1, bottom + 1, right - 1, top - 1]
+            self.assertEqual(tile_range(GRID, 3, inside), (x, y, x, y))
+
+    def test_range_is_clamped_to_the_grid(self):
+        self.assertEqual(tile_range(GRID, 2, [-1e9, -1e9, 1e9, 1e9]), (0, 0, 3, 3))
+        self.assertEqual(tile_range(GRID, 0, [-1e9, -1e9, 1e9, 1e9]), (0, 0, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()